@@ -21,107 +21,315 @@
 DBus utility functions for the hidpi daemon.  On Gnome we need to talk to Mutter over its dbus api to set scaling on nvidia systems.
 """
 
+import logging
+from collections import namedtuple
+
 from gi.repository import Gio, GLib
 
+log = logging.getLogger(__name__)
+
+DISPLAY_CONFIG_NAME = 'org.gnome.Mutter.DisplayConfig'
+DISPLAY_CONFIG_PATH = '/org/gnome/Mutter/DisplayConfig'
+DISPLAY_CONFIG_INTERFACE = 'org.gnome.Mutter.DisplayConfig'
+
+# Milliseconds to wait for Mutter before giving up on a call.  A busy or hung
+# gnome-shell must not stall hotplug handling indefinitely.
+CALL_TIMEOUT = 5000
+
+# ApplyMonitorsConfig methods.  VERIFY only checks whether Mutter would
+# accept the configuration, without changing anything.
+METHOD_VERIFY = 0
+METHOD_TEMPORARY = 1
+METHOD_PERSISTENT = 2
+
+CURRENT_STATE_TYPE = '(ua((ssss)a(siiddada{sv})a{sv})a(iiduba(ssss)a{sv})a{sv})'
+
 
-def dbus_helper(destination = 'org.gnome.Mutter.DisplayConfig',
-                path        = '/org/gnome/Mutter/DisplayConfig',
-                interface   = 'org.gnome.Mutter.DisplayConfig',
+def dbus_helper(destination = DISPLAY_CONFIG_NAME,
+                path        = DISPLAY_CONFIG_PATH,
+                interface   = DISPLAY_CONFIG_INTERFACE,
                 method      = None,
                 args        = None,
                 answer_fmt  = None,
                 proxy_prpty = Gio.DBusCallFlags.NONE,
                 timeout     = -1,
-                cancellable = None 
+                cancellable = None,
+                bus         = None
                 ):
     
-    bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+    if bus is None:
+        bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
     reply = bus.call_sync(destination, path, interface,
                       method, args, answer_fmt,
                       proxy_prpty, timeout, cancellable)
     return reply
 
+# GetCurrentState, typed.  Each mode carries its supported scales as a
+# frozenset, and logical monitors refer to the full Monitor entries.
+Mode = namedtuple('Mode', ['id', 'width', 'height', 'refresh', 'preferred_scale', 'scales', 'properties'])
+Monitor = namedtuple('Monitor', ['connector', 'vendor', 'product', 'serial', 'modes', 'properties'])
+LogicalMonitor = namedtuple('LogicalMonitor', ['x', 'y', 'scale', 'transform', 'primary', 'monitors', 'properties'])
+
+
+class CurrentState:
+    def __init__(self, serial, monitors, logical_monitors, properties=None):
+        self.serial = serial
+        self.monitors = monitors
+        self.logical_monitors = logical_monitors
+        self.properties = properties if properties is not None else {}
+        self.by_connector = dict((m.connector, m) for m in monitors)
+        self.by_spec = dict(((m.vendor, m.product, m.serial), m) for m in monitors)
+
+    def get_monitor(self, connector):
+        return self.by_connector.get(connector)
+
+    def find_monitor(self, vendor, product, serial):
+        return self.by_spec.get((vendor, product, serial))
+
+    def get_scale(self):
+        # The largest scale of any logical monitor, at least 1.
+        scale = 1.0
+        for log_mon in self.logical_monitors:
+            if log_mon.scale > scale:
+                scale = log_mon.scale
+        return scale
+
+
 def unpack_current_state(current_state):
-    configuration_serial = current_state[0]
-    monitors = current_state[1]
-    log_displays = current_state[2]
-    logical_displays = []
-    for log_display in log_displays:
-        logical_display = { 'x_position' : log_display[0],
-                            'y_position' : log_display[1],
-                            'scale'      : log_display[2],
-                            'transform'  : log_display[3],
-                            'primary'    : log_display[4]
-                          }
-        #logical_displays.append(logical_display)
-        log_monitors = log_display[5]
-        processed_monitors = []
-        for monitor in log_monitors:
-            processed_monitor = {}
-            processed_monitor['connector'] = monitor[0]
-            processed_monitor['vendor']    = monitor[1]
-            processed_monitor['product']   = monitor[2]
-            processed_monitor['serial']    = monitor[3]
-            for mon in monitors:
-                if mon[0][0] == monitor[0]:
-                    processed_monitor['modes'] = mon[1]
-            processed_monitors.append(processed_monitor)
-        logical_display['monitors'] = processed_monitors
-        logical_displays.append(logical_display)
-    return configuration_serial, logical_displays
+    if isinstance(current_state, GLib.Variant):
+        current_state = current_state.unpack()
+    configuration_serial, monitors, log_displays, properties = current_state
+    physical = []
+    for spec, modes, monitor_properties in monitors:
+        physical.append(Monitor(
+            spec[0], spec[1], spec[2], spec[3],
+            tuple(Mode(m[0], m[1], m[2], m[3], m[4], frozenset(m[5]), m[6]) for m in modes),
+            monitor_properties,
+        ))
+    # If a connector is listed twice, the last entry wins.
+    by_connector = dict((m.connector, m) for m in physical)
+    logical = []
+    for x, y, scale, transform, primary, specs, log_properties in log_displays:
+        log_monitors = []
+        for spec in specs:
+            monitor = by_connector.get(spec[0])
+            if monitor is None:
+                monitor = Monitor(spec[0], spec[1], spec[2], spec[3], (), {})
+            log_monitors.append(monitor)
+        logical.append(LogicalMonitor(x, y, scale, transform, primary, tuple(log_monitors), log_properties))
+    return CurrentState(configuration_serial, tuple(physical), tuple(logical), properties)
 
-def get_current_state():
-    current_state = dbus_helper(method='GetCurrentState', 
-                                answer_fmt  = GLib.VariantType.new ('(ua((ssss)a(siiddada{sv})a{sv})a(iiduba(ssss)a{sv})a{sv})')
-    )
-    
-    return unpack_current_state(current_state)
-    
-def apply_monitors_configuration(configuration_serial, displays, scale):
+def build_monitors_configuration(state, scale, method=METHOD_TEMPORARY):
+    # Keep the layout, put every monitor in its first (preferred) mode and
+    # use the scale wherever all of a logical monitor's modes support it.
     displays_arg = []
-    
-    for display in displays:
-        #generate monitors argument for each display
+    for log_mon in state.logical_monitors:
         monitors_arg = []
         display_scale = scale
-        for monitor in display['monitors']:
-            monitors_arg.append(( 
-                        monitor['connector'], 
-                        monitor['modes'][0][0], 
+        for monitor in log_mon.monitors:
+            mode = monitor.modes[0]
+            monitors_arg.append((
+                        monitor.connector,
+                        mode.id,
                         {
                             'underscanning': GLib.Variant('b', False)
                         }
                     ))
-            if scale not in monitor['modes'][0][5]:
+            if scale not in mode.scales:
                 display_scale = 1.0
-        display_arg = (
-                    display['x_position'], 
-                    display['y_position'], 
-                    display_scale, 
-                    display['transform'], 
-                    display['primary'], 
-                    monitors_arg, 
-                )
-        displays_arg.append(display_arg)
-    args = GLib.Variant('(uua(iiduba(ssa{sv}))a{sv})', ( configuration_serial, 1,
+        displays_arg.append((
+                    log_mon.x,
+                    log_mon.y,
+                    display_scale,
+                    log_mon.transform,
+                    log_mon.primary,
+                    monitors_arg,
+                ))
+    args = GLib.Variant('(uua(iiduba(ssa{sv}))a{sv})', ( state.serial, method,
             displays_arg,
                 {
                 },
             )
             )
-    dbus_helper(method='ApplyMonitorsConfig',
-                    args = args)
+    return args
+
+
+class DisplayConfig:
+    # Client for Mutter's DisplayConfig API.  Holds one bus connection and
+    # the last GetCurrentState reply, so repeated scale queries within a
+    # configuration pass don't each cost a round trip to Mutter.
+    #
+    # The cached state is dropped when Mutter emits MonitorsChanged (if a
+    # main loop dispatches it), after every ApplyMonitorsConfig, and by
+    # invalidate() whenever the caller changed the configuration behind
+    # Mutter's back (RandR, nvidia-settings).
+    #
+    # The *_async() methods need a running GLib main loop.  They can be
+    # aborted with cancel(), eg. when a newer hotplug makes a pending scale
+    # change pointless.
+    def __init__(self, bus=None, timeout=CALL_TIMEOUT):
+        self.bus = bus
+        self.timeout = timeout
+        self.subscription = None
+        self.current_state = None # CurrentState
+        self.cancellable = Gio.Cancellable()
+
+    def get_bus(self):
+        if self.bus is None:
+            self.bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+        if self.subscription is None:
+            self.subscription = self.bus.signal_subscribe(
+                DISPLAY_CONFIG_NAME,
+                DISPLAY_CONFIG_INTERFACE,
+                'MonitorsChanged',
+                DISPLAY_CONFIG_PATH,
+                None,
+                Gio.DBusSignalFlags.NONE,
+                self.on_monitors_changed,
+            )
+        return self.bus
+
+    def call(self, method, args=None, answer_fmt=None):
+        return dbus_helper(method=method, args=args, answer_fmt=answer_fmt,
+                           timeout=self.timeout, bus=self.get_bus())
+
+    def call_async(self, method, args=None, answer_fmt=None, callback=None, cancellable=None):
+        # callback(reply, error) runs from the main loop; exactly one of the
+        # two is None.
+        if cancellable is None:
+            cancellable = self.cancellable
+        self.get_bus().call(DISPLAY_CONFIG_NAME, DISPLAY_CONFIG_PATH, DISPLAY_CONFIG_INTERFACE,
+                            method, args, answer_fmt, Gio.DBusCallFlags.NONE,
+                            self.timeout, cancellable, self.on_call_finished, (method, callback))
+
+    def on_call_finished(self, bus, result, data):
+        method, callback = data
+        try:
+            reply = bus.call_finish(result)
+        except GLib.Error as error:
+            if error.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                log.debug('%s cancelled', method)
+            if callback is not None:
+                callback(None, error)
+            return
+        if callback is not None:
+            callback(reply, None)
+
+    def cancel(self):
+        # Abort all pending asynchronous calls.
+        self.cancellable.cancel()
+        self.cancellable = Gio.Cancellable()
+
+    def on_monitors_changed(self, connection, sender, path, interface, signal, parameters):
+        log.debug('Mutter monitors changed')
+        self.invalidate()
+
+    def invalidate(self):
+        self.current_state = None
+
+    @property
+    def serial(self):
+        return self.get_current_state().serial
+
+    def get_current_state(self):
+        if self.current_state is None:
+            current_state = self.call('GetCurrentState',
+                                      answer_fmt=GLib.VariantType.new(CURRENT_STATE_TYPE))
+            self.current_state = unpack_current_state(current_state)
+        return self.current_state
+
+    def get_current_state_async(self, callback, cancellable=None):
+        # callback(current_state, error)
+        if self.current_state is not None:
+            callback(self.current_state, None)
+            return
+        def on_reply(reply, error):
+            if error is not None:
+                callback(None, error)
+                return
+            self.current_state = unpack_current_state(reply)
+            callback(self.current_state, None)
+        self.call_async('GetCurrentState', answer_fmt=GLib.VariantType.new(CURRENT_STATE_TYPE),
+                        callback=on_reply, cancellable=cancellable)
+
+    def apply_monitors_configuration(self, state, scale, method=METHOD_TEMPORARY):
+        args = build_monitors_configuration(state, scale, method)
+        if method == METHOD_VERIFY:
+            try:
+                self.call('ApplyMonitorsConfig', args=args)
+            except:
+                # Possibly a stale serial.
+                self.invalidate()
+                raise
+            return
+        try:
+            self.call('ApplyMonitorsConfig', args=args)
+        finally:
+            # Either the configuration changed, or the serial was stale.
+            self.invalidate()
+
+    def apply_monitors_configuration_async(self, state, scale,
+                                           callback=None, cancellable=None, method=METHOD_TEMPORARY):
+        args = build_monitors_configuration(state, scale, method)
+        # Drop the cached state now: calls on one connection are answered in
+        # order, so a GetCurrentState issued after this sees the new state.
+        self.invalidate()
+        def on_reply(reply, error):
+            self.invalidate()
+            if callback is not None:
+                callback(reply, error)
+        self.call_async('ApplyMonitorsConfig', args=args, callback=on_reply, cancellable=cancellable)
+
+    def get_scale(self):
+        return self.get_current_state().get_scale()
+
+    def set_scale(self, scale, method=METHOD_TEMPORARY):
+        self.apply_monitors_configuration(self.get_current_state(), scale, method)
+
+    def verify_scale(self, scale):
+        # True if Mutter would accept the scale for the current configuration.
+        try:
+            self.set_scale(scale, METHOD_VERIFY)
+        except Exception as error:
+            log.debug('Mutter would reject scale %r: %s', scale, error)
+            return False
+        return True
+
+    def set_scale_async(self, scale, callback=None, cancellable=None):
+        # callback(reply, error), also when getting the current state failed.
+        if cancellable is None:
+            cancellable = self.cancellable
+        def on_current_state(current_state, error):
+            if error is not None:
+                if callback is not None:
+                    callback(None, error)
+                return
+            self.apply_monitors_configuration_async(current_state, scale,
+                                                    callback=callback, cancellable=cancellable)
+        self.get_current_state_async(on_current_state, cancellable=cancellable)
+
+
+_display_config = None
+
+def get_display_config():
+    global _display_config
+    if _display_config is None:
+        _display_config = DisplayConfig()
+    return _display_config
+
+def get_current_state():
+    return get_display_config().get_current_state()
+
+def apply_monitors_configuration(state, scale, method=METHOD_TEMPORARY):
+    get_display_config().apply_monitors_configuration(state, scale, method)
 
 def get_scale():
-    configuration_serial, displays = get_current_state()
-    scale = 1.0
-    for display in displays:
-        if display['scale'] > scale:
-            scale = display['scale']
-    return scale
-
-def set_scale(scale):
-    configuration_serial, displays = get_current_state()
-    apply_monitors_configuration(configuration_serial, displays, scale)
+    return get_display_config().get_scale()
+
+def set_scale(scale, method=METHOD_TEMPORARY):
+    get_display_config().set_scale(scale, method)
+
+def verify_scale(scale):
+    return get_display_config().verify_scale(scale)
     
 #set_scale(2.0)
@@ -0,0 +1,101 @@
+# hidpi-daemon: HiDPI daemon to manage HiDPI and LoDPI monitors on X
+# Copyright (C) 2017-2018 System76, Inc.
+#
+# This file is part of `hidpi-daemon`.
+#
+# `hidpi-daemon` is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# `hidpi-daemon` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with `hidpi-daemon`; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Decode the EDID of connected monitors.  Vendor, product and serial are decoded the same way as in ~/.config/monitors.xml so saved configurations can be matched.
+"""
+
+from collections import namedtuple
+
+
+Edid = namedtuple('Edid', ['vendor', 'product', 'serial', 'mm_width', 'mm_height', 'preferred'])
+Timing = namedtuple('Timing', ['width', 'height', 'refresh', 'pixel_clock'])
+
+# Parsed EDIDs keyed by the raw bytes.  Only grows with the number of
+# different monitors plugged in, but don't let a flaky connection fill it.
+_cache = {}
+MAX_CACHED = 32
+
+DESCRIPTORS = range(0x36, 0x7E, 0x12)
+DESCRIPTOR_SERIAL = 0xff
+DESCRIPTOR_NAME = 0xfc
+
+
+def parse_edid(raw):
+    raw = bytes(raw)
+    try:
+        return _cache[raw]
+    except KeyError:
+        pass
+    edid = _parse_edid(raw)
+    if len(_cache) >= MAX_CACHED:
+        _cache.clear()
+    _cache[raw] = edid
+    return edid
+
+def _get_descriptor_string(raw, tag):
+    value = None
+    for i in DESCRIPTORS:
+        if raw[i] == 0x00 and raw[i+3] == tag:
+            value = bytes(0x00 if c == 0x0a else c for c in raw[i+5:i+18])
+    if value is None:
+        return None
+    return value.decode('utf-8', errors='replace')
+
+def _get_preferred_timing(raw):
+    # The first detailed timing descriptor is the preferred mode.
+    dtd = raw[0x36:0x48]
+    pixel_clock = (dtd[0] | dtd[1] << 8) * 10000
+    if pixel_clock == 0:
+        return None
+    width = dtd[2] | (dtd[4] & 0xf0) << 4
+    hblank = dtd[3] | (dtd[4] & 0x0f) << 8
+    height = dtd[5] | (dtd[7] & 0xf0) << 4
+    vblank = dtd[6] | (dtd[7] & 0x0f) << 8
+    total = (width + hblank) * (height + vblank)
+    refresh = pixel_clock / total if total else 0
+    return Timing(width, height, refresh, pixel_clock)
+
+def _parse_edid(raw):
+    if len(raw) < 128:
+        return None
+
+    vendor_id = raw[9] + (raw[8] << 8)
+    vendor = ''.join(chr(ord('@') + ((vendor_id >> shift) & 0x1f)) for shift in (10, 5, 0))
+
+    product = _get_descriptor_string(raw, DESCRIPTOR_NAME)
+    if product is None:
+        product = str(hex(raw[10] + (raw[11] << 8)))
+    else:
+        product = product.rstrip(' ').rstrip('\x00')
+
+    serial = _get_descriptor_string(raw, DESCRIPTOR_SERIAL)
+    if serial is None:
+        serial = str.format('0x{:08x}', raw[12] + (raw[13] << 8) + (raw[14] << 16) + (raw[15] << 24))
+    else:
+        serial = serial.rstrip('\x00')
+
+    # Prefer the detailed timing's image size (mm) over the basic one (cm).
+    mm_width = raw[0x42] | (raw[0x44] & 0xf0) << 4
+    mm_height = raw[0x43] | (raw[0x44] & 0x0f) << 8
+    if mm_width == 0 or mm_height == 0:
+        mm_width = raw[0x15] * 10
+        mm_height = raw[0x16] * 10
+
+    return Edid(vendor, product, serial, mm_width, mm_height, _get_preferred_timing(raw))
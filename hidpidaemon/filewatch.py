@@ -0,0 +1,112 @@
+# hidpi-daemon: HiDPI daemon to manage HiDPI and LoDPI monitors on X
+# Copyright (C) 2017-2018 System76, Inc.
+#
+# This file is part of `hidpi-daemon`.
+#
+# `hidpi-daemon` is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# `hidpi-daemon` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with `hidpi-daemon`; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Watch the files the daemon caches (monitors.xml, the daemon config) with inotify through Gio file monitors.
+"""
+
+import json
+import logging
+
+from gi.repository import Gio
+
+log = logging.getLogger(__name__)
+
+DAEMON_CONF = '/etc/system76-daemon.json'
+
+
+def load_json_conf(filename):
+    try:
+        fp = open(filename, 'r')
+    except FileNotFoundError:
+        return {}
+    try:
+        obj = json.load(fp)
+    except Exception:
+        log.exception('Error loading JSON conf from %r', filename)
+        return {}
+    if isinstance(obj, dict):
+        return obj
+    log.warning('does not contain JSON dict: %r', filename)
+    return {}
+
+
+class FileWatch:
+    # Gio watches the parent directory as well, so this also catches the
+    # file being created, deleted or atomically replaced (as Mutter does
+    # with monitors.xml).  Callbacks run from the GLib main loop.
+    def __init__(self, filename, callback):
+        self.filename = filename
+        self.callback = callback
+        self.monitor = Gio.File.new_for_path(filename).monitor_file(Gio.FileMonitorFlags.NONE, None)
+        self.monitor.connect('changed', self.on_changed)
+
+    def on_changed(self, monitor, changed_file, other_file, event_type):
+        if event_type == Gio.FileMonitorEvent.CHANGED:
+            # Wait for CHANGES_DONE_HINT rather than reacting to every write.
+            return
+        log.debug('%r changed (%s)', self.filename, event_type.value_nick)
+        self.callback(self.filename)
+
+    def cancel(self):
+        self.monitor.cancel()
+
+
+class DaemonConfig:
+    def __init__(self, filename=DAEMON_CONF):
+        self.filename = filename
+        self.conf = load_json_conf(filename)
+        self.callbacks = []
+        self.watch = None
+
+    def get(self, key, default=None):
+        return self.conf.get(key, default)
+
+    def is_hidpi_disabled(self):
+        return self.get('disable-hidpi') == "True"
+
+    def connect(self, callback):
+        if callback not in self.callbacks:
+            self.callbacks.append(callback)
+
+    def disconnect(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    def start_watch(self):
+        if self.watch is None:
+            self.watch = FileWatch(self.filename, self.reload)
+
+    def reload(self, filename=None):
+        conf = load_json_conf(self.filename)
+        if conf == self.conf:
+            return
+        log.info('reloaded %r', self.filename)
+        self.conf = conf
+        for callback in self.callbacks:
+            callback(self)
+
+
+_daemon_config = None
+
+def get_daemon_config():
+    global _daemon_config
+    if _daemon_config is None:
+        _daemon_config = DaemonConfig()
+    return _daemon_config
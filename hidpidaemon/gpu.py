@@ -0,0 +1,122 @@
+# hidpi-daemon: HiDPI daemon to manage HiDPI and LoDPI monitors on X
+# Copyright (C) 2017-2018 System76, Inc.
+#
+# This file is part of `hidpi-daemon`.
+#
+# `hidpi-daemon` is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# `hidpi-daemon` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with `hidpi-daemon`; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Detect the graphics driver once, and again only when kernel modules are loaded or unloaded.
+"""
+
+import logging
+from os import path
+from shutil import which
+
+import gi
+try:
+    gi.require_version('GUdev', '1.0')
+    from gi.repository import GUdev
+except (ImportError, ValueError):
+    GUdev = None
+
+log = logging.getLogger(__name__)
+
+# Checked in order; the first loaded module is the display driver.
+DRIVERS = (
+    'nvidia',
+    'nouveau',
+    'amdgpu',
+    'radeon',
+    'i915',
+)
+
+
+def read_modules(filename='/proc/modules'):
+    try:
+        with open(filename, 'r') as fp:
+            return set(line.split(' ', 1)[0] for line in fp)
+    except OSError:
+        return set()
+
+
+class GpuProbe:
+    def __init__(self, proc_modules='/proc/modules', sysdir='/sys'):
+        self.proc_modules = proc_modules
+        self.sysdir = sysdir
+        self.udev = None
+        self.vendor = None
+        self.callbacks = []
+        self.probe()
+
+    def connect(self, callback):
+        # callback(probe) runs whenever a re-probe changed the vendor.
+        if callback not in self.callbacks:
+            self.callbacks.append(callback)
+
+    def disconnect(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    def probe(self):
+        prev_vendor = self.vendor
+        modules = read_modules(self.proc_modules)
+        self.driver = None
+        for driver in DRIVERS:
+            if driver in modules:
+                self.driver = driver
+                break
+        self.nvidia_loaded = 'nvidia' in modules
+        self.nvidia_settings = which('nvidia-settings') is not None
+        # Only the proprietary driver with nvidia-settings is handled as
+        # NVIDIA; everything else is configured like Intel graphics.
+        if self.nvidia_loaded and self.nvidia_settings:
+            self.vendor = 'nvidia'
+        else:
+            self.vendor = 'intel'
+        log.info('GPU: vendor=%r driver=%r nvidia-settings=%r', self.vendor, self.driver, self.nvidia_settings)
+        if prev_vendor is not None and self.vendor != prev_vendor:
+            for callback in list(self.callbacks):
+                callback(self)
+
+    def watch_udev(self):
+        # Re-probe on module add/remove uevents.  Needs a GLib main loop and
+        # the optional GUdev typelib; without it use poll().
+        if GUdev is None or self.udev is not None:
+            return self.udev is not None
+        self.udev = GUdev.Client(subsystems=['module'])
+        self.udev.connect('uevent', self.on_uevent)
+        return True
+
+    def on_uevent(self, client, action, device):
+        if action in ('add', 'remove'):
+            self.probe()
+
+    def poll(self):
+        # Cheap on-demand check for when udev isn't available: a stat() of
+        # /sys/module/nvidia instead of reading all of /proc/modules.
+        if self.udev is not None:
+            return
+        if path.isdir(path.join(self.sysdir, 'module', 'nvidia')) != self.nvidia_loaded:
+            self.probe()
+
+
+_gpu_probe = None
+
+def get_gpu_probe():
+    global _gpu_probe
+    if _gpu_probe is None:
+        _gpu_probe = GpuProbe()
+    return _gpu_probe
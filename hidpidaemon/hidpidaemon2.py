@@ -30,6 +30,7 @@ from Xlib.ext import randr
 import logging
 import time
 import os
+import select
 import gi
 
 gi.require_version('Gtk', '3.0')
@@ -41,13 +42,18 @@ from pydbus.generic import signal as PyDBusSignal
 import signal
 
 import subprocess
-import re
 import threading, queue
-from shutil import which
 from collections import namedtuple
 
 from hidpidaemon import dbusutil
+from hidpidaemon import filewatch
+from hidpidaemon import gpu
+from hidpidaemon import lid
 from hidpidaemon import monitorsxml
+from hidpidaemon import nvidia
+from hidpidaemon import randrutil
+from hidpidaemon import scheduler
+from hidpidaemon import snapshot
 
 log = logging.getLogger(__name__)
 
@@ -110,8 +116,30 @@ if major < 0 or minor < 20:
     randr.GetOutputProperty = xlib._GetOutputProperty
     randr.get_output_property = xlib._get_output_property
 
+    randr.GetScreenResourcesCurrent = xlib._GetScreenResourcesCurrent
+    randr.get_screen_resources_current = xlib._get_screen_resources_current
+
 XRes = namedtuple('XRes', ['x', 'y'])
 
+# Everything set_scaled_display_modes() decides from, see plan_display_modes().
+DisplayPlan = namedtuple('DisplayPlan', [
+    'vendor',
+    'scale_mode',
+    'unforce',
+    'force',
+    'dpi_types',        # (has_mixed_dpi, has_hidpi, has_lowdpi)
+    'prime_types',      # (has_lowdpi_prime, has_hidpi_prime)
+    'lid_open',
+    'outputs',          # connected snapshot.OutputSnapshot
+    'disabled',         # NVIDIA: connectors disabled in monitors.xml
+    'layout',           # ((display, (x, y)), ...)
+    'config_timestamp', # of the snapshot the plan was computed from
+])
+
+# Seconds between full rescans of all outputs.  In between, only outputs
+# named by RRNotify events are queried again.
+RESCAN_INTERVAL = 30
+
 class HiDPIGSettings(GObject.GObject):
     enable = GObject.Property(type=bool, default=True)
     mode = GObject.Property(type=str, default='lodpi')
@@ -154,6 +182,10 @@ class HiDPIAutoscaling:
     def __init__(self, model):
         self.model = model
         self.displays = dict() # {'LVDS-0': 'connected', 'HDMI-0': 'disconnected'}
+        self.snapshot = None # Last DisplaySnapshot, see update_display_connections()
+        self.changed_outputs = set() # Outputs named by RRNotify events since the last update
+        self.rescan_needed = True
+        self.last_rescan = 0
         self.screen_maximum = XRes(x=8192, y=8192)
         self.pixel_doubling = False
         self.scale_mode = 'hidpi' # If we have nvidia with the proprietary driver, set to hidpi for pixel doubling
@@ -162,9 +194,32 @@ class HiDPIAutoscaling:
         self.unforce = False
         self.saved = True
         self.calculated_display_size = (0,0) # Used to hack around intel black band bug (wrong XScreen size)
+        self.lid = lid.get_lid_state()
         self.prev_lid_state = self.get_internal_lid_state()
+        self.geometry = None # Per layout pass, see snapshot_geometry()
+        self.crtc_infos = None
         self.dbs = HiDPIDBusServer()
         self.pub = None
+        self.config = filewatch.get_daemon_config()
+        self.hidpi_disabled = self.config.is_hidpi_disabled() # As of the last config (re)load
+        self.output_mode_added = False # MODEL_MODES mode created, see add_output_mode()
+        self.gpu = gpu.get_gpu_probe()
+        self.display_config = dbusutil.get_display_config()
+        self.mainloop = False # True when running from the GLib main loop, see run_mainloop()
+        self.xlib_source = None # GLib sources of the main loop mode, see teardown()
+        self.rescan_source = None
+        self.update_source = None
+        self.pending_source = None # See schedule_continuation()
+        self.notification_settings = None
+        self.notification_mode_handler = None
+        self.monitors_xml_watch = None
+        self.metamode_session = None # nvidia.MetaModeSession of the current pass
+        self.crtc_transaction = None # randrutil.CrtcTransaction of the current pass
+        self.applied_plan = None # DisplayPlan last applied, and Mutter's serial once it was in place
+        self.applied_serial = None
+        self.apply_ok = True # False once a step of the current apply pass failed
+        self.nvidia_backend = None
+        self.coalescer = scheduler.Coalescer(*scheduler.get_coalescer_settings(self.config))
 
         self.init_gsettings()
         self.init_xlib()
@@ -174,32 +229,75 @@ class HiDPIAutoscaling:
         self.settings = Gio.Settings('com.system76.hidpi')
         #self.settings.bind('mode', self.gsettings, 'mode', Gio.SettingsBindFlags.DEFAULT)
 
+    def init_filewatch(self):
+        # Keep monitors.xml and the daemon config parsed until they actually
+        # change on disk, and apply config changes without a restart.
+        filename = monitorsxml.get_monitors_xml_path()
+        self.monitors_xml_watch = filewatch.FileWatch(filename, monitorsxml.invalidate)
+        monitorsxml.set_watched(filename)
+        self.config.connect(self.on_config_changed)
+        self.config.start_watch()
+
+    def on_config_changed(self, config):
+        self.coalescer.configure(*scheduler.get_coalescer_settings(config))
+        # Other keys (eg. 'event-quiet-window') live in the same file; only
+        # act when 'disable-hidpi' itself changed.
+        disabled = config.is_hidpi_disabled()
+        if disabled == self.hidpi_disabled:
+            return
+        self.hidpi_disabled = disabled
+        if disabled:
+            log.info('HiDPI scaling disabled by %r', config.filename)
+        else:
+            log.info('HiDPI scaling enabled by %r', config.filename)
+            # Skipped by init_xlib() if the daemon started disabled.
+            if self.get_gpu_vendor() != 'nvidia' and not self.output_mode_added:
+                self.add_output_mode()
+            self.notification_update_scaling()
+
     def init_xlib(self):
         self.xlib_display = xdisplay.Display()
         screen = self.xlib_display.screen()
         self.xlib_window = screen.root.create_window(10,10,10,10,0, 0, window_class=X.InputOnly, visual=X.CopyFromParent, event_mask=0)
-        self.xlib_window.xrandr_select_input(randr.RRScreenChangeNotifyMask)
-        #            | randr.RROutputChangeNotifyMask
+        self.screen_resources = randrutil.ScreenResources(self.xlib_window)
+        self.xlib_window.xrandr_select_input(randr.RRScreenChangeNotifyMask
+                    | randr.RROutputChangeNotifyMask
+                    | randr.RRCrtcChangeNotifyMask)
         #            | randr.RROutputPropertyNotifyMask)
 
         self.update_display_connections()
+        self.init_vendor()
+
+        self.displays_xml = self.get_displays_xml()
+
+    def init_vendor(self):
+        # Everything that depends on the GPU vendor; runs again from
+        # on_gpu_changed() when the driver is loaded or unloaded.
+        self.scale_mode = 'hidpi'
         if self.get_gpu_vendor() == 'nvidia':
-            self.scale_mode = 'hidpi'
             self.screen_maximum = XRes(x=32768, y=32768)
         else:
-            self.add_output_mode()
+            self.screen_maximum = XRes(x=8192, y=8192)
+            if not self.config.is_hidpi_disabled() and not self.output_mode_added:
+                # While disabled, don't touch the X configuration at all.
+                self.add_output_mode()
 
-        self.displays_xml = self.get_displays_xml()
+    def on_gpu_changed(self, probe):
+        if self.model in INTEL:
+            return
+        log.info('GPU vendor changed to %r, reconfiguring', probe.vendor)
+        self.nvidia_backend = None
+        self.applied_plan = None
+        self.applied_serial = None
+        self.rescan_needed = True
+        self.init_vendor()
+        self.notification_update_scaling()
 
     #Test for nvidia proprietary driver and nvidia-settings
     def get_gpu_vendor(self):
         if self.model in INTEL:
             return 'intel'
-        modules = open('/proc/modules', 'r')
-        if 'nvidia ' in modules.read() and which('nvidia-settings') is not None:
-            return 'nvidia'
-        else:
-            return 'intel'
+        return self.gpu.vendor
 
     def add_output_mode(self):
         # GALP2 EXAMPLE
@@ -207,6 +305,7 @@ class HiDPIAutoscaling:
         # '1600x900  118.25  1600 1696 1856 2112  900 903 908 934 -hsync +vsync',
         if self.model not in MODEL_MODES:
             return
+        self.output_mode_added = True
         modeline = MODEL_MODES[self.model].split()
         mode_id = 0
         #mode_name = modeline[0]
@@ -224,8 +323,9 @@ class HiDPIAutoscaling:
             # Eventually, we'll need to handle picking a 'close' mode if we can't make one.
             pass
 
-        time.sleep(0.1)
-        resources = self.xlib_window.xrandr_get_screen_resources()._data
+        if not self.mainloop:
+            time.sleep(0.1)
+        resources = self.screen_resources.get()
         selected_output = None
         for output in resources['outputs']:
             info = randr.get_output_info(self.xlib_display, output, resources['config_timestamp'])._data
@@ -239,170 +339,102 @@ class HiDPIAutoscaling:
         self.update_display_connections()
 
     def get_displays_xml(self):
+        # Match connected monitors against saved configurations using the
+        # EDIDs read by update_display_connections().
         mon_list = []
-        resources = self.xlib_window.xrandr_get_screen_resources()._data
-        for output in resources['outputs']:
-            info = randr.get_output_info(self.xlib_display, output, resources['config_timestamp'])._data
-
-            properties_list = self.xlib_display.xrandr_list_output_properties(output)._data
-            for atom in properties_list['atoms']:
-                atom_name = self.xlib_display.get_atom_name(atom)
-                if atom_name == 'EDID':
-                    prop = randr.get_output_property(self.xlib_display, output, atom, 19, 0, 128)._data
-                    edid = bytes(prop['value'])
-                    # get edid vendor code
-                    edidv = prop['value'][9] + (prop['value'][8] << 8)
-                    char1 = (int(edidv) & 0x7C00) >> 10
-                    char2 = (int(edidv) & 0x3E0) >> 5
-                    char3 = (int(edidv) & 0x001F) >> 0
-                    table = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M', 'N', 'O', 'P', 'Q', 'R', 'S', 'T', 'U', 'V', 'W', 'X', 'Y', 'Z']
-                    edid_vendor = table[char1-1] + table[char2-1] + table[char3-1]
-
-                    edidp = prop['value'][10] + (prop['value'][11] << 8)
-                    modelname = None
-                    for i in range(0x36, 0x7E, 0x12):
-                        if edid[i] == 0x00 and edid[i+3] ==0xfc:
-                            modelname = []
-                            for j in range(0,13):
-                                if edid[i+5+j] == 0x0a:
-                                    modelname.append(0x00)
-                                else:
-                                    modelname.append(edid[i+5+j])
-                    if not modelname:
-                        edid_product = str(hex(edidp))
-                    else:
-                        edid_product = bytes(modelname).decode('utf-8').rstrip(' ').rstrip('\x00')
-
-                    edids = prop['value'][12] + (prop['value'][13] << 8) + (prop['value'][14] << 16) + (prop['value'][15] << 24)
-                    edid_serial = str.format('0x{:08x}', edids)
-                    serial = None
-                    for i in range(0x36, 0x7E, 0x12):
-                        if edid[i] == 0x00 and edid[i+3] ==0xff:
-                            serial = []
-                            for j in range(0,13):
-                                if edid[i+5+j] == 0x0a:
-                                    serial.append(0x00)
-                                else:
-                                    serial.append(edid[i+5+j])
-                    if not serial:
-                        edid_serial = str.format('0x{:08x}', edids)
-                    else:
-                        edid_serial = bytes(serial).decode('utf-8').rstrip('\x00')
-
-                    mon_list.append({'connector': info['name'], 'vendor': edid_vendor, 'product': edid_product, 'serial': edid_serial})
-
+        for display in self.displays:
+            info = self.displays[display].get('edid')
+            if info is not None:
+                mon_list.append({'connector': display, 'vendor': info.vendor, 'product': info.product, 'serial': info.serial})
 
         xml = monitorsxml.MonitorsXml()
         c = xml.get_config_from_monitors(mon_list)
         return c
 
 
-    def update_display_connections(self):
-        resources = self.xlib_window.xrandr_get_screen_resources()._data
+    def record_event(self, e):
+        # Note what a RandR event changed, for the next incremental update.
+        # Returns False for events that aren't RandR changes.
+        if e.type == self.xlib_display.extension_event.ScreenChangeNotify:
+            # Only a real hotplug (new config_timestamp) needs the
+            # X server to re-probe outputs.
+            if e.config_timestamp != self.screen_resources.config_timestamp:
+                self.rescan_needed = True
+            self.screen_resources.invalidate(e.config_timestamp)
+            return True
+        notify = randrutil.parse_rrnotify(self.xlib_display, e)
+        if notify is None:
+            return False
+        if notify.sub_code == randr.RRNotify_OutputChange:
+            self.changed_outputs.add(notify.output)
+        elif notify.sub_code == randr.RRNotify_CrtcChange:
+            if self.crtc_infos is not None:
+                self.crtc_infos.pop(notify.crtc, None)
+            if self.snapshot is not None:
+                self.changed_outputs.update(self.snapshot.get_outputs_on_crtc(notify.crtc))
+        return True
+
+    def update_display_connections(self, incremental=False):
+        resources = self.screen_resources.get()
         self.resources = resources
 
-        modes = dict()
-        for mode in resources['modes']:
-            modes[mode['id']] = mode
+        if incremental and not self.rescan_needed and self.snapshot is not None \
+                and time.monotonic() - self.last_rescan < RESCAN_INTERVAL:
+            # Only query outputs that changed, or appeared.
+            known = set(o.output for o in self.snapshot)
+            changed = self.changed_outputs | (set(resources['outputs']) - known)
+            outputs, primary = randrutil.query_outputs(self.xlib_display, self.xlib_window, resources, edid=True,
+                                                       outputs=sorted(changed))
+            new_snapshot = self.snapshot.update(resources, outputs, primary)
+        else:
+            outputs, primary = randrutil.query_outputs(self.xlib_display, self.xlib_window, resources, edid=True)
+            new_snapshot = snapshot.DisplaySnapshot.from_outputs(resources, outputs)
+            self.rescan_needed = False
+            self.last_rescan = time.monotonic()
+        self.changed_outputs = set()
 
-        try:
-            primary_output = self.xlib_window.xrandr_get_output_primary()._data['output']
-        except:
-            primary_output = None
+        lid_state = self.get_internal_lid_state()
+        lid_changed = lid_state != self.prev_lid_state
+        self.prev_lid_state = lid_state
 
-        new_displays = dict()
-        for output in resources['outputs']:
-            info = randr.get_output_info(self.xlib_display, output, resources['config_timestamp'])._data
-            modelist = []
-            for mode_id in info['modes']:
-                mode = modes[mode_id]
-                modelist.append(mode._data)
-            new_displays[info['name']] = dict()
-            new_displays[info['name']]['connected'] = not bool(info['connection'])
-            new_displays[info['name']]['mm_width'] = info['mm_width']
-            new_displays[info['name']]['mm_height'] = info['mm_height']
-            new_displays[info['name']]['modes'] = modelist
-            new_displays[info['name']]['crtc'] = info['crtc']
-            if primary_output == output:
-                new_displays[info['name']]['primary'] = True
-
-            # Get connector type for each display. 'Panel' indicates internal display.
-            new_displays[info['name']]['connector_type'] = ''
-            properties_list = self.xlib_display.xrandr_list_output_properties(output)._data
-            for atom in properties_list['atoms']:
-                atom_name = self.xlib_display.get_atom_name(atom)
-                if atom_name == randr.PROPERTY_CONNECTOR_TYPE:
-                    prop = randr.get_output_property(self.xlib_display, output, atom, 4, 0, 100)._data
-                    connector_type = self.xlib_display.get_atom_name(prop['value'][0])
-                    new_displays[info['name']]['connector_type'] = connector_type
-                if atom_name == 'PRIME Synchronization':
-                    new_displays[info['name']]['prime'] = True
+        # Nothing changed since the last check.
+        if new_snapshot == self.snapshot and not lid_changed:
+            return False
 
+        diff = new_snapshot.diff(self.snapshot)
+        self.snapshot = new_snapshot
+        self.displays = new_snapshot.get_displays()
+        if diff.hotplug:
+            log.info('displays changed: added=%r removed=%r connection=%r crtc_lost=%r crtc_gained=%r',
+                diff.added, diff.removed, diff.connection_changed, diff.crtc_lost, diff.crtc_gained)
 
         # In some cases, the CRTC won't have changed when the lid opens.
         # So update displays if the lid state has changed.
-        lid_state = self.get_internal_lid_state()
-        if lid_state != self.prev_lid_state:
-            self.prev_lid_state = lid_state
-
+        if lid_changed:
             # Always update displays on lid open
             if lid_state:
-                self.displays = new_displays
                 # delay to prevent race
-                time.sleep(1)
+                if not self.mainloop:
+                    time.sleep(1)
+                elif incremental:
+                    # Don't block the main loop, update() continues from a
+                    # timeout.
+                    self.schedule_continuation(1000, self.on_lid_open_timeout)
+                    return False
                 return True
             # Only update displays on lid close if an external display is connected.
             # This prevents mutter crashes.
-            else:
-                for display in new_displays:
-                    status = new_displays[display]['connected']
-                    connector_type = new_displays[display]['connector_type']
-                    if 'eDP' in display or connector_type == 'Panel':
-                        pass
-                    elif status == True:
-                        self.displays = new_displays
-                        return True
-        else:
-            self.prev_lid_state = lid_state
-
-
-        for display in new_displays:
-            status = new_displays[display]['connected']
-            if display in self.displays:
-                old_status = self.displays[display]['connected']
-                if status != old_status:
-                    self.displays = new_displays
+            for output in new_snapshot:
+                if output.connected and not output.is_internal():
                     return True
-                # Need to check for laptop lid closed.
-                # When laptop lid is closed, crtc is 0, when open it should be a positive integer.
-                new_crtc = new_displays[display]['crtc']
-                old_crtc = self.displays[display]['crtc']
-                if new_crtc != old_crtc:
-                    if new_crtc == 0 or old_crtc == 0:
-                        self.displays = new_displays
-                        return True
-            else:
-                self.displays = new_displays
-                return True
-
-        self.displays = new_displays
-        return False
-
-    def acpid_listen(self):
-        import socket
-
-        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        s.connect("/var/run/acpid.socket")
 
-        while True:
-            for event in s.recv(4096).decode('utf-8').split('\n'):
-                event = event.split(' ')
-                if event[0] == 'button/lid':
-                    if event[2] == 'open':
-                        self.notification_update_scaling()
-                    elif event[2] == 'close':
-                        pass
+        # Connections changed, or a CRTC was switched on or off.
+        # When laptop lid is closed, crtc is 0, when open it should be a positive integer.
+        return diff.hotplug
 
+    def on_lid_changed(self, is_open):
+        if is_open:
+            self.notification_update_scaling()
 
     def notification_terminate(self, status):
         self.pub.unpublish()
@@ -443,9 +475,12 @@ class HiDPIAutoscaling:
                     self.unforce = True
             self.queue.put(self.scale_mode)
             self.queue.put(self.unforce)
+        if self.config.is_hidpi_disabled():
+            return
         if self.get_gpu_vendor() == 'intel':
             # for threading reasons, create a new autoscaling instance...but do not call run() on it!
             h = HiDPIAutoscaling(self.model)
+            h.mainloop = self.mainloop
             h.unforce = self.unforce
             h.saved = not self.unforce
             h.set_scaled_display_modes(notification=False)
@@ -455,10 +490,11 @@ class HiDPIAutoscaling:
             # needed.
             has_mixed_dpi, has_hidpi, has_lowdpi = self.has_mixed_hi_low_dpi_displays()
             if not has_lowdpi and self.unforce:
-                if dbusutil.get_scale() < 2:
+                if self.display_config.get_scale() < 2:
                     h.set_scaled_display_modes(notification=False)
         if self.get_gpu_vendor() == 'nvidia': # nvidia
             h = HiDPIAutoscaling(self.model)
+            h.mainloop = self.mainloop
             h.scale_mode = self.scale_mode
             h.set_scaled_display_modes(notification=False)
             if self.workaround_prime_detect_lowdpi_primary():
@@ -469,10 +505,11 @@ class HiDPIAutoscaling:
         self.notification_send_signal()
         self.notification_update_scaling(restart=False)
 
-    def notification_register_dbus(self, has_mixed_dpi, unforce):
+    def notification_publish_dbus(self):
         settings = HiDPIGSettings()
         self.settings.bind('mode', settings, 'mode', Gio.SettingsBindFlags.DEFAULT)
-        settings.connect('notify::mode', self.on_notification_mode)
+        self.notification_mode_handler = settings.connect('notify::mode', self.on_notification_mode)
+        self.notification_settings = settings
 
         self.dbs = HiDPIDBusServer()
 
@@ -482,6 +519,9 @@ class HiDPIAutoscaling:
             self.queue.put(self.dbs)
             self.queue.put(self.pub)
 
+    def notification_register_dbus(self, has_mixed_dpi, unforce):
+        # Legacy threaded mode: D-Bus and GSettings get their own main loop.
+        self.notification_publish_dbus()
         self.loop = GLib.MainLoop()
         GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGINT, self.notification_terminate, None)
         self.loop.run()
@@ -507,8 +547,9 @@ class HiDPIAutoscaling:
 
     def workaround_show_prime_set_primary_dialog(self):
         # Show dialog to request switching hidpi display if the primary display is lowdpi
+        # Returns True if the scale mode or the primary display changed.
         if not self.workaround_prime_detect_lowdpi_primary():
-            return
+            return False
 
         output = subprocess.check_output('/usr/lib/hidpi-daemon/prime-dialog').decode('utf-8')
         response = Gtk.ResponseType(int(output))
@@ -516,48 +557,73 @@ class HiDPIAutoscaling:
         if response == Gtk.ResponseType.CANCEL:
             self.scale_mode = 'lowdpi'
             self.settings.set_string('mode', 'lodpi')
+            return True
         elif response == Gtk.ResponseType.OK:
             self.scale_mode = 'hidpi'
-            resources = self.xlib_window.xrandr_get_screen_resources()._data
+            resources = self.screen_resources.get()
             for output in resources['outputs']:
                 info = randr.get_output_info(self.xlib_display, output, resources['config_timestamp'])._data
                 if 'eDP-1' in info['name']:
                     self.xlib_window.xrandr_set_output_primary(output)
-                    return
+                    return True
+        return False
 
 
-    def get_display_position(self, display_name, align=(0,0)):
-        # For performance reasons, self.resources must be set with self.xlib_window.xrandr_get_screen_resources() before calling.
-        #resources = self.xlib_window.xrandr_get_screen_resources()._data
-        resources = self.resources._data
+    def get_crtc_info(self, crtc):
+        # For performance reasons, self.resources must be set with self.screen_resources.get() before calling.
+        if self.crtc_transaction is not None and crtc in self.crtc_transaction.crtc_infos:
+            return self.crtc_transaction.crtc_infos[crtc]
+        if self.crtc_infos is not None and crtc in self.crtc_infos:
+            return self.crtc_infos[crtc]
+        return randr.get_crtc_info(self.xlib_display, crtc, self.resources['config_timestamp'])._data
+
+    def snapshot_geometry(self):
+        # Layout looks up display positions many times per display.  Fetch
+        # all CRTCs in one batch and work out every display's rectangle once,
+        # so a layout pass costs a single round trip.
+        crtcs = set()
+        for display in self.displays:
+            if self.displays[display]['crtc'] != 0:
+                crtcs.add(self.displays[display]['crtc'])
+        self.crtc_infos = randrutil.query_crtcs(self.xlib_display, crtcs, self.resources['config_timestamp'])
+        self.geometry = {}
+        for display in self.displays:
+            self.geometry[display] = self.get_display_rect(display)
+
+    def clear_geometry(self):
+        self.geometry = None
+        self.crtc_infos = None
+
+    def get_display_rect(self, display_name):
+        # Returns (x, y, width, height, integral); positions from a CRTC are
+        # rounded to integers once aligned.
         crtc = self.displays[display_name]['crtc']
         connected = self.displays[display_name]['connected']
         if self.displays_xml:
             for log_mon in self.displays_xml['logical_monitors']:
                 if log_mon['monitor_spec']['connector'] == display_name:
                     try:
-                        x = int(log_mon['x']) + align[0] * int(log_mon['mode']['width'])
-                        y = int(log_mon['y']) + align[1] * int(log_mon['mode']['height'])
-                        return x, y
+                        return int(log_mon['x']), int(log_mon['y']), int(log_mon['mode']['width']), int(log_mon['mode']['height']), False
                     except:
-                        -1, -1
+                        pass
 
         if crtc != 0:
-            crtc_info = randr.get_crtc_info(self.xlib_display, crtc, resources['config_timestamp'])._data
-            if align != (0,0):
-                # Align to integer for easier/more consistent math elsewhere
-                mode = dict()
-                mode['width'] = crtc_info['width']
-                mode['height'] = crtc_info['height']
-                x = int(crtc_info['x'] + align[0] * mode['width'])
-                y = int(crtc_info['y'] + align[1] * mode['height'])
-                return x, y
-            else:
-                return crtc_info['x'], crtc_info['y']
+            crtc_info = self.get_crtc_info(crtc)
+            return crtc_info['x'], crtc_info['y'], crtc_info['width'], crtc_info['height'], True
         elif connected == True and not self.panel_activation_override(display_name):
-            return 0, 0
+            return 0, 0, 0, 0, True
+        else:
+            return -1, -1, 0, 0, True
+
+    def get_display_position(self, display_name, align=(0,0)):
+        if self.geometry is not None and display_name in self.geometry:
+            x, y, width, height, integral = self.geometry[display_name]
         else:
-            return -1, -1
+            x, y, width, height, integral = self.get_display_rect(display_name)
+        if integral:
+            # Align to integer for easier/more consistent math elsewhere
+            return int(x + align[0] * width), int(y + align[1] * height)
+        return x + align[0] * width, y + align[1] * height
 
     def get_display_dpi(self, display_name, current=False, saved=False):
         width = self.displays[display_name]['mm_width']
@@ -567,10 +633,9 @@ class HiDPIAutoscaling:
 
         if current:
             try:
-                resources = self.resources._data
                 crtc = self.displays[display_name]['crtc']
                 if crtc != 0:
-                    crtc_info = randr.get_crtc_info(self.xlib_display, crtc, resources['config_timestamp'])._data
+                    crtc_info = self.get_crtc_info(crtc)
                     mode = dict()
                     mode['width'] = crtc_info['width']
                     mode['height'] = crtc_info['height']
@@ -797,8 +862,14 @@ class HiDPIAutoscaling:
         # adjacent displays.  We build and traverse a graph of these adjacent
         # displays and position each display relative to its neighbor.
 
-        self.resources = self.xlib_window.xrandr_get_screen_resources()
+        self.resources = self.screen_resources.get()
+        self.snapshot_geometry()
+        try:
+            return self._calculate_layout2(revert)
+        finally:
+            self.clear_geometry()
 
+    def _calculate_layout2(self, revert):
         center_lookup_entries_x,       center_lookup_entries_y       = self.get_aligned_layout_entries((0.5,0.5))
         top_left_lookup_entries_x,     top_left_lookup_entries_y     = self.get_aligned_layout_entries((0.0,0.0))
         bottom_right_lookup_entries_x, bottom_right_lookup_entries_y = self.get_aligned_layout_entries((1.0,1.0))
@@ -1037,22 +1108,7 @@ class HiDPIAutoscaling:
         return display_positions
 
     def get_internal_lid_state(self):
-        try:
-            lid_file_path = '/proc/acpi/button/lid/LID0/state'
-            if os.path.isfile(lid_file_path):
-                lids_path = '/proc/acpi/button/lid/'
-                lid_dirs = [d for d in os.listdir(lids_path) if os.path.isdir(os.path.join(lids_path, d))]
-                if len(lid_dirs) < 1:
-                    return True # No lids found: System may not be a laptop.
-                else:
-                    lid_file_path = os.path.join('/', 'proc', 'acpi', 'button', 'lid', lid_dirs[0], 'state')
-            lid_file = open(lid_file_path, 'r')
-            if 'open' in lid_file.read():
-                return True
-            else:
-                return False
-        except:
-            return True
+        return self.lid.is_open()
 
     def panel_activation_override(self, display_name):
         try:
@@ -1064,44 +1120,26 @@ class HiDPIAutoscaling:
             return False
         return False
 
-    def get_nvidia_settings_options(self, display_name, viewportin, viewportout):
-        cmd = [ 'nvidia-settings', '-q', 'CurrentMetaMode' ]
-        output = subprocess.check_output(cmd).decode("utf-8")
-        deprettified_currentmetamode = re.sub(r'(\n )|(\n\n)', r'', output)
-
-        dpys = subprocess.check_output(['nvidia-settings', '-q', 'dpys'])
-        reg = re.compile(r'\[([0-9])\] (?:.*?)\[dpy\:([.0-9])\] \((.*?)\)')
-        tokens = reg.findall(str(dpys))
-        dpy_mapping = {}
-        for entry in tokens:
-            idx, dpy_num, connector_name = entry
-            dpy_mapping["DPY-" + dpy_num] = connector_name
-
-        reg = re.compile(r'((?:DPY\-\d).*?})')
-        reg = re.compile(r'(DPY\-\d).*?(\{.*?\})')
-        display_attribute_pairs = reg.findall(deprettified_currentmetamode)
-        attribute_mapping = {}
-        for pair in display_attribute_pairs:
-            connector_name = dpy_mapping[pair[0]]
-            if connector_name == display_name:
-                attributes = pair[1]
-                attributes = re.sub(r'ViewPortIn\=\d*x\d*(, )?', r'', attributes)
-                attributes = re.sub(r'ViewPortOut\=\d*x\d*\+\d\+\d(, )?', r'', attributes)
-                attributes = re.sub(r'ForceCompositionPipeline=\w*(, )?', r'', attributes)
-                attributes = re.sub(r'{', r'{ViewPortOut=' + viewportout + ', ', attributes)
-                attributes = re.sub(r'{', r'{ViewPortIn=' + viewportin + ', ', attributes)
-                attributes = re.sub(r'}', r'ForceCompositionPipeline=On}, ', attributes)
-                attribute_mapping[connector_name] = attributes
-
-        # Create new attributes if we are activating a currently inactive display.
-        # This fixes issues when plugging multiple displays in at the same time.
-        if display_name not in attribute_mapping:
-            attributes = '{ViewPortIn=' + viewportin + ', ' + \
-                        'ViewPortOut=' + viewportout + ', ' + \
-                        'ForceCompositionPipeline=On}, '
-            attribute_mapping[display_name] = attributes
-
-        return attribute_mapping[display_name]
+    def get_metamode_session(self):
+        if self.metamode_session is None:
+            self.metamode_session = nvidia.MetaModeSession(self.get_nvidia_backend())
+        return self.metamode_session
+
+    def get_nvidia_backend(self):
+        if self.nvidia_backend is None:
+            self.nvidia_backend = nvidia.get_backend(self.xlib_display)
+            log.info('Setting metamodes with %s', self.nvidia_backend.name)
+        return self.nvidia_backend
+
+    def assign_metamode(self, entries):
+        # Entries from set_display_scaling(); the '' returned for displays
+        # configured through RandR are skipped.
+        metamode = nvidia.serialize_metamode([e for e in entries if e])
+        if not self.get_nvidia_backend().set_current_metamode(metamode):
+            self.note_apply_error()
+        # The metamode and Mutter's state both changed.
+        self.metamode_session = None
+        self.display_config.invalidate()
 
 
     def set_display_scaling_nvidia_settings(self, display_name, layout, scale_mode):
@@ -1121,7 +1159,6 @@ class HiDPIAutoscaling:
         dpi = self.get_display_dpi(display_name)
         if dpi is None:
             return ''
-        display_str = display_name + ": nvidia-auto-select "
 
         mode = self.displays[display_name]['modes'][0]
         res_out_x = mode['width']
@@ -1151,15 +1188,53 @@ class HiDPIAutoscaling:
             return ''
         panning_pos = "+" + str(pan_x) + "+" + str(pan_y)
 
-        viewportin = str(res_in_x) + "x" + str(res_in_y) + " "
+        viewportin = str(res_in_x) + "x" + str(res_in_y)
         viewportout = str(res_out_x) + "x" + str(res_out_y) + panning_pos
 
-        display_str = display_str + "@" + str(res_in_x) + "x" + str(res_in_y) + " "
-        display_str = display_str + "+" + str(pan_x) + "+" + str(pan_y) + " "
-        display_str = display_str + self.get_nvidia_settings_options(display_name, viewportin, viewportout)
-        return display_str
+        return self.get_metamode_session().get_entry(display_name, viewportin, panning_pos, viewportin, viewportout)
+
+    def begin_crtc_transaction(self, config_timestamp=None):
+        # Collect the CRTC configs of set_display_scaling_xrandr() calls
+        # until commit_crtc_transaction(), and apply them all at once.  The
+        # configs are checked against the config_timestamp of the snapshot
+        # they were computed from, so a hotplug in between makes the X
+        # server refuse them.
+        if config_timestamp is None:
+            config_timestamp = self.snapshot.config_timestamp
+        crtc_infos = randrutil.query_crtcs(self.xlib_display, self.snapshot.crtcs, config_timestamp)
+        self.crtc_transaction = randrutil.CrtcTransaction(self.xlib_display, self.xlib_window,
+                                                          config_timestamp, crtc_infos)
+        return self.crtc_transaction
+
+    def commit_crtc_transaction(self):
+        # Returns False if the configs couldn't be applied.
+        transaction = self.crtc_transaction
+        self.crtc_transaction = None
+        if transaction is None or not transaction.configs:
+            return True
+        ok = transaction.commit()
+        if not ok:
+            log.info("Could not apply CRTC configuration")
+            self.note_apply_error()
+        if transaction.stale:
+            # Outputs changed since the snapshot: re-probe on the next update.
+            self.rescan_needed = True
+            self.screen_resources.invalidate()
+        if transaction.applied:
+            self.display_config.invalidate()
+        return ok
 
     def set_display_scaling_xrandr(self, display_name, layout, force_lowdpi=True):
+        if self.crtc_transaction is not None:
+            return self.add_display_scaling_xrandr(display_name, layout, force_lowdpi)
+        # Not part of a layout pass: apply this display on its own.
+        self.begin_crtc_transaction()
+        try:
+            return self.add_display_scaling_xrandr(display_name, layout, force_lowdpi)
+        finally:
+            self.commit_crtc_transaction()
+
+    def add_display_scaling_xrandr(self, display_name, layout, force_lowdpi=True):
         native_dpi = self.get_display_dpi(display_name)
         saved_dpi = self.get_display_dpi(display_name, saved=True)
         current_dpi = self.get_display_dpi(display_name, current=True)
@@ -1167,26 +1242,20 @@ class HiDPIAutoscaling:
             current_dpi = 0
         dpi = None
 
-        resources = self.xlib_window.xrandr_get_screen_resources()._data
         crtc = self.displays[display_name]['crtc']
         mode = None
 
-        try:
-            crtc_info = randr.get_crtc_info(self.xlib_display, crtc, resources['config_timestamp'])._data
-        except:
+        crtc_info = self.crtc_transaction.crtc_infos.get(crtc)
+        if crtc_info is None:
             return ''
 
         # Get appropriate Mode and DPI
         if crtc != 0 and current_dpi <= 170 and force_lowdpi:
             # use current dpi and resolution
-            try:
-                crtc_info = randr.get_crtc_info(self.xlib_display, crtc, resources['config_timestamp'])._data
-                mode = dict()
-                mode['width'] = crtc_info['width']
-                mode['height'] = crtc_info['height']
-                dpi = current_dpi
-            except:
-                return ''
+            mode = dict()
+            mode['width'] = crtc_info['width']
+            mode['height'] = crtc_info['height']
+            dpi = current_dpi
         if self.displays_xml:
             if saved_dpi <= 170 and force_lowdpi:
                 #use saved resolution
@@ -1198,29 +1267,17 @@ class HiDPIAutoscaling:
                         dpi = saved_dpi
             elif saved_dpi > 170 and force_lowdpi:
                 # use half of max redolution
-                try:
-                    crtc_info = randr.get_crtc_info(self.xlib_display, crtc, resources['config_timestamp'])._data
-                    mode = self.displays[display_name]['modes'][0]
-                    dpi = native_dpi
-                except:
-                    return ''
+                mode = self.displays[display_name]['modes'][0]
+                dpi = native_dpi
                 # later halve it
             else:
-                try:
-                    crtc_info = randr.get_crtc_info(self.xlib_display, crtc, resources['config_timestamp'])._data
-                    mode = self.displays[display_name]['modes'][0]
-                    dpi = native_dpi
-                except:
-                    return ''
+                mode = self.displays[display_name]['modes'][0]
+                dpi = native_dpi
 
         else:
             # use native resolution
-            try:
-                crtc_info = randr.get_crtc_info(self.xlib_display, crtc, resources['config_timestamp'])._data
-                mode = self.displays[display_name]['modes'][0]
-                dpi = native_dpi
-            except:
-                return ''
+            mode = self.displays[display_name]['modes'][0]
+            dpi = native_dpi
 
 
         if dpi is None:
@@ -1240,34 +1297,32 @@ class HiDPIAutoscaling:
             return ''
 
         #now find the mode we want
-        new_mode = None
-        for mode in self.displays[display_name]['modes']:
-            if mode['width'] == x_res and mode['height'] == y_res:
-                new_mode = mode
-                break
+        new_mode = self.snapshot.find_mode(display_name, x_res, y_res)
 
         if self.panel_activation_override(display_name):
             return ''
 
-        try:
-            randr.set_crtc_config(self.xlib_display,crtc, int(time.time()), int(pan_x), int(pan_y), new_mode['id'], crtc_info['rotation'], crtc_info['outputs'])
-        except:
+        if new_mode is None:
             log.info("Could not set CRTC for " + str(display_name))
+            return ''
+        self.crtc_transaction.set_crtc(crtc, pan_x, pan_y, new_mode, crtc_info['rotation'], crtc_info['outputs'])
 
         return ''
 
-    def set_display_scaling(self, display, layout, force=False, lowdpi_prime=False):
+    def set_display_scaling(self, display, layout, force=False, lowdpi_prime=False, scale_mode=None):
         if self.displays[display]['modes'] == []:
             return ''
+        if scale_mode is None:
+            scale_mode = self.scale_mode
         if self.get_gpu_vendor() == 'nvidia':
             if 'prime' in self.displays[display]:
                 return self.set_display_scaling_xrandr(display, layout, force_lowdpi=force)
             else:
                 # If a lowdpi prime display is present, don't pixel-double any lowdpi displays.
-                if lowdpi_prime and self.scale_mode == 'hidpi':
+                if lowdpi_prime and scale_mode == 'hidpi':
                     mode = 'lowdpi_prime'
                 else:
-                    mode = self.scale_mode
+                    mode = scale_mode
                 return self.set_display_scaling_nvidia_settings(display, layout, scale_mode=mode)
         elif self.get_gpu_vendor() == 'intel':
             return self.set_display_scaling_xrandr(display, layout, force_lowdpi=force)
@@ -1310,17 +1365,57 @@ class HiDPIAutoscaling:
 
         return has_mixed_dpi, found_hidpi, found_lowdpi
 
-    def set_scaled_display_modes(self, notification=True):
-        # Don't set resolutions at all if disabled to prevent issues.
-        if self.settings.get_boolean('enable') == False:
+    def set_scale_nowait(self, scale, message):
+        # Set Mutter's scale without waiting for the result, which is only
+        # logged.  Needs the GLib main loop; the legacy threaded mode waits.
+        if not self.mainloop:
+            try:
+                self.display_config.set_scale(scale)
+            except:
+                log.info(message)
+                self.note_apply_error()
             return
+        def on_reply(reply, error):
+            if error is not None:
+                log.info('%s: %s', message, error.message)
+                self.note_apply_error()
+        self.display_config.set_scale_async(scale, callback=on_reply)
+
+    def set_scale_nvidia(self, scale, force, message):
+        # Returns False if the scale was set already.
+        if self.display_config.get_scale() == scale:
+            return False
+        # Plan up front instead of learning by exception: Mutter's verify
+        # method tells whether the scale works with the current metamode.
+        if self.display_config.verify_scale(scale):
+            try:
+                self.display_config.set_scale(scale)
+                return True
+            except:
+                log.info('Mutter rejected verified scale %r', scale)
+
+        # Need to setup displays at native resolution before setting scale.
+        layout_native = self.calculate_layout2(revert=True)
+        metamode_native = []
+        self.begin_crtc_transaction()
+        for display in self.displays:
+            if self.displays[display]['connected'] == True:
+                metamode_native.append(self.set_display_scaling(display, layout_native, force=force))
+        self.commit_crtc_transaction()
+        self.assign_metamode(metamode_native)
+        try:
+            self.display_config.set_scale(scale)
+        except:
+            log.info(message)
+            self.note_apply_error()
+        return True
 
+    def plan_display_modes(self):
+        # Work out the configuration for the current displays and settings,
+        # without changing anything.
         has_mixed_dpi, has_hidpi, has_lowdpi = self.has_mixed_hi_low_dpi_displays()
         has_lowdpi_prime, has_hidpi_prime = self.has_prime_displays()
 
-        if has_hidpi_prime and has_lowdpi and self.scale_mode == 'hidpi':
-            self.workaround_show_prime_set_primary_dialog()
-
         self.displays_xml = self.get_displays_xml()
         layout = self.calculate_layout2(revert=self.unforce)
 
@@ -1329,205 +1424,413 @@ class HiDPIAutoscaling:
             force = has_hidpi
         else:
             force = False
-
-        # For each connected display, configure display modes.
-        cmd = ''
-        off_displays = []
-        if self.get_gpu_vendor() == 'nvidia' and self.displays_xml is not None:
-            for d in self.displays_xml['disabled']:
-                if 'monitor_spec' in d:
-                    off_displays.append(d['monitor_spec']['connector'])
         for display in self.displays:
             if self.displays[display]['connected'] == True:
                 if 'prime' in self.displays[display]:
                     if self.scale_mode == 'hidpi':
                         force = False
-        for display in self.displays:
-            if self.displays[display]['connected'] == True:
-                # INTEL: set the display crtc
-                # NVIDIA: just get display parameters for nvidia-settings line
-                if self.displays[display]['crtc'] == 0:
-                    off_displays.append(display)
-                elif 'prime' in self.displays[display]:
-                    self.set_display_scaling(display, layout, force=force)
-                else:
-                    cmd = cmd + self.set_display_scaling(display, layout, force=force, lowdpi_prime=has_lowdpi_prime)
+
+        disabled = []
+        if self.get_gpu_vendor() == 'nvidia' and self.displays_xml is not None:
+            for d in self.displays_xml['disabled']:
+                if 'monitor_spec' in d:
+                    disabled.append(d['monitor_spec']['connector'])
+
+        return DisplayPlan(
+            self.get_gpu_vendor(),
+            self.scale_mode,
+            self.unforce,
+            force,
+            (has_mixed_dpi, has_hidpi, has_lowdpi),
+            (has_lowdpi_prime, has_hidpi_prime),
+            self.get_internal_lid_state(),
+            tuple(o for o in self.snapshot if o.connected),
+            tuple(disabled),
+            tuple(sorted((display, tuple(pos)) for (display, pos) in layout.items())),
+            self.snapshot.config_timestamp,
+        )
+
+    def set_scaled_display_modes(self, notification=True):
+        # Don't set resolutions at all if disabled to prevent issues.
+        if self.settings.get_boolean('enable') == False or self.config.is_hidpi_disabled():
+            return
+
+        # The dialog can change the scale mode or the primary display, which
+        # the plan depends on.
+        has_mixed_dpi, has_hidpi, has_lowdpi = self.has_mixed_hi_low_dpi_displays()
+        has_lowdpi_prime, has_hidpi_prime = self.has_prime_displays()
+        if has_hidpi_prime and has_lowdpi and self.scale_mode == 'hidpi':
+            if self.workaround_show_prime_set_primary_dialog():
+                self.update_display_connections()
+
+        plan = self.plan_display_modes()
+        # Same plan as last time, and Mutter's serial hasn't changed since it
+        # was in place: nothing to do.  The serial comes from the cached
+        # state, which is only fetched again once Mutter reports a change
+        # (MonitorsChanged, with the GLib main loop).
+        if plan == self.applied_plan and self.applied_serial is not None:
+            if self.get_mutter_serial() == self.applied_serial:
+                log.debug('Display configuration already applied')
+                return
+
+        if not self.mainloop:
+            # Without a main loop, Mutter's MonitorsChanged signal isn't
+            # dispatched and the cached state may be stale.
+            self.display_config.invalidate()
+        self.apply_ok = True
+        if self.apply_display_plan(plan):
+            self.applied_plan = plan
+            self.applied_serial = self.get_mutter_serial()
+        else:
+            # Try again on the next event.
+            self.applied_plan = None
+            self.applied_serial = None
+
+    def note_apply_error(self):
+        # A step of the apply pass failed, so its plan isn't in place.  Also
+        # called for asynchronous scale changes that fail after the pass.
+        self.apply_ok = False
+        self.applied_plan = None
+
+    def get_mutter_serial(self):
+        try:
+            return self.display_config.serial
+        except:
+            return None
+
+    def apply_display_plan(self, plan):
+        # Apply a DisplayPlan, skipping whatever is already in place.
+        # Returns False if any step failed.
+        # A scale change still pending from an earlier pass is out of date.
+        self.display_config.cancel()
+        # Query nvidia-settings at most once for all displays.
+        self.metamode_session = None
+
+        has_mixed_dpi, has_hidpi, has_lowdpi = plan.dpi_types
+        has_lowdpi_prime, has_hidpi_prime = plan.prime_types
+
+        layout = dict(plan.layout)
+        force = plan.force
+
+        # For each connected display, configure display modes.
+        metamode = [] # NVIDIA: metamode entries for nvidia-settings
+        off_displays = list(plan.disabled)
+        transaction = self.begin_crtc_transaction(plan.config_timestamp)
+        for output in plan.outputs:
+            display = output.name
+            # INTEL: set the display crtc
+            # NVIDIA: just get display parameters for nvidia-settings line
+            if output.crtc == 0:
+                off_displays.append(display)
+            elif output.prime:
+                self.set_display_scaling(display, layout, force=force, scale_mode=plan.scale_mode)
+            else:
+                metamode.append(self.set_display_scaling(display, layout, force=force, lowdpi_prime=has_lowdpi_prime,
+                                                         scale_mode=plan.scale_mode))
+        # INTEL and PRIME: apply the CRTC configs collected above.
+        self.commit_crtc_transaction()
+        if transaction.stale:
+            # A hotplug since the plan was made; its update plans again.
+            log.info('Display configuration changed while applying, not continuing')
+            return False
         # NVIDIA: got parameters for nvidia-settings - actually set display modes
-        if self.get_gpu_vendor() == 'nvidia':
+        if plan.vendor == 'nvidia':
             if has_hidpi:
                 # First set scale mode manually since Mutter can't see the effective display resolution.
-                # Step 1) Let's try setting scale.  If this works, we can skip the later steps (less flickering).
-                # Step 2) That didn't work.  We'll need to set everything up at the native resolution for Mutter
+                # Step 1) Ask Mutter (verify method) whether the scale can be set as-is.  If so, set it and skip
+                #         the later steps (less flickering).
+                # Step 2) It can't.  We'll need to set everything up at the native resolution for Mutter
                 #         to accept the display configuration.  Calculate a layout and nvidia-settings cmd at
                 #         native resolution and set it momentarily.
-                # Step 3) Try setting the scale with displays at native resolution.  This should almost always work.
-                if self.scale_mode == 'lowdpi':
-                    try:
-                        dbusutil.set_scale(1)
-                    except:
-                        # Need to setup displays at native resolution before setting scale.
-                        layout_native = self.calculate_layout2(revert=True)
-                        cmd_native = ''
-                        for display in self.displays:
-                            if self.displays[display]['connected'] == True:
-                                cmd_native = cmd_native + self.set_display_scaling(display, layout_native, force=force)
-                        subprocess.call('nvidia-settings --assign CurrentMetaMode="' + cmd_native + '"', shell=True)
-                        try:
-                            dbusutil.set_scale(1)
-                        except:
-                            log.info("Could not set Mutter scale mode lowdpi")
-                elif dbusutil.get_scale() < 2.0:
+                # Step 3) Set the scale with displays at native resolution.  This should almost always work.
+                changed = False
+                if plan.scale_mode == 'lowdpi':
+                    changed = self.set_scale_nvidia(1, force, "Could not set Mutter scale mode lowdpi")
+                elif self.display_config.get_scale() < 2.0:
                     #Need to set a display mode Mutter is happy with before setting scale
-                    try:
-                        dbusutil.set_scale(2)
-                    except:
-                        # Need to setup displays at native resolution before setting scale.
-                        layout_native = self.calculate_layout2(revert=True)
-                        cmd_native = ''
-                        for display in self.displays:
-                            if self.displays[display]['connected'] == True:
-                                cmd_native = cmd_native + self.set_display_scaling(display, layout_native, force=force)
-                        subprocess.call('nvidia-settings --assign CurrentMetaMode="' + cmd_native + '"', shell=True)
-                        try:
-                            dbusutil.set_scale(2)
-                        except:
-                            log.info("Could not set Mutter scale mode hidpi")
-                # Let things settle down.
-                time.sleep(0.1)
-                for display in self.displays:
-                    if self.displays[display]['connected'] == True and 'prime' in self.displays[display]:
-                        self.set_display_scaling(display, layout, force=force)
+                    changed = self.set_scale_nvidia(2, force, "Could not set Mutter scale mode hidpi")
+                if changed:
+                    # Let things settle down.
+                    time.sleep(0.1)
+                transaction = self.begin_crtc_transaction(plan.config_timestamp)
+                for output in plan.outputs:
+                    if output.prime:
+                        self.set_display_scaling(output.name, layout, force=force, scale_mode=plan.scale_mode)
+                self.commit_crtc_transaction()
+                if transaction.stale:
+                    log.info('Display configuration changed while applying, not continuing')
+                    return False
                 # Now call nvidia settings with the metamodes we calculated in set_display_scaling()
-                if cmd != "":
-                    subprocess.call('nvidia-settings --assign CurrentMetaMode="' + cmd + '"', shell=True)
-                if self.scale_mode == 'lowdpi' and dbusutil.get_scale() > 1.0:
-                    try:
-                        dbusutil.set_scale(1)
-                    except:
-                        log.info("Could not set Mutter scale mode lowdpi")
+                metamode = [e for e in metamode if e]
+                if metamode and not self.get_metamode_session().is_current(metamode):
+                    self.assign_metamode(metamode)
+                if plan.scale_mode == 'lowdpi' and self.display_config.get_scale() > 1.0:
+                    self.set_scale_nowait(1, "Could not set Mutter scale mode lowdpi")
             # We don't have any hidpi displays (maybe one was disconnected).
             # No need to call nvidia-settings, but the scale could still be 2x.
             # Set scale back to 1x, so the user isn't stuck with everything unusably large.
-            elif has_lowdpi and dbusutil.get_scale() > 1:
-                try:
-                    dbusutil.set_scale(1)
-                except:
-                    log.info("Could not set Mutter scale mode only lowdpi")
+            elif has_lowdpi and self.display_config.get_scale() > 1:
+                self.set_scale_nowait(1, "Could not set Mutter scale mode only lowdpi")
         # Special cases on INTEL.  Specifically 'native resolution' mode has some quirks.
-        elif self.get_gpu_vendor() == 'intel' and force == False:
+        elif plan.vendor == 'intel' and force == False:
             try:
-                current_scale = dbusutil.get_scale()
+                current_scale = self.display_config.get_scale()
             except:
                 current_scale = 2
             if current_scale < 2:
-                for display in self.displays:
-                    if self.displays[display]['connected']:
-                        # Under some circumstances, Mutter may not set the scaling.
-                        # In 'native resolution' ('unforced') mode, we must set scaling if:
-                        # a) - the internal panel is hidpi
-                        # b) - there is an external panel between 170 and 192 dpi (mutter already sets scale if above 192)
-                        #    - and no lowdpi monitors are present (1x scaling is better if there are)
-                        if self.panel_activation_override(display):
-                            pass
-                        elif ('eDP' in display or self.displays[display]['connector_type'] == 'Panel'):
-                            if self.get_display_dpi(display) > 192:
-                                try:
-                                    dbusutil.set_scale(2)
-                                except:
-                                    log.info("Could not set Mutter scale internal hidpi")
-                        elif self.get_display_dpi(display) > 170 and not has_lowdpi: # same thing for external displays
-                            try:
-                                dbusutil.set_scale(2)
-                            except:
-                                log.info("Could not set Mutter scale external hidpi")
+                for output in plan.outputs:
+                    display = output.name
+                    # Under some circumstances, Mutter may not set the scaling.
+                    # In 'native resolution' ('unforced') mode, we must set scaling if:
+                    # a) - the internal panel is hidpi
+                    # b) - there is an external panel between 170 and 192 dpi (mutter already sets scale if above 192)
+                    #    - and no lowdpi monitors are present (1x scaling is better if there are)
+                    if self.panel_activation_override(display):
+                        pass
+                    elif output.is_internal():
+                        if self.get_display_dpi(display) > 192:
+                            self.set_scale_nowait(2, "Could not set Mutter scale internal hidpi")
+                    elif self.get_display_dpi(display) > 170 and not has_lowdpi: # same thing for external displays
+                        self.set_scale_nowait(2, "Could not set Mutter scale external hidpi")
 
         # Work around Mutter(?) bug where the X Screen (not output) resolution is set too small.
         # Because of this, sometimes some displays may be rendered partially or completely black.
-        # Calling 'xrandr --auto' causes the correct screen size to be set without other notable changes.
-        if self.get_gpu_vendor() == 'intel':
+        # Setting the screen size we calculated fixes that without other notable changes.
+        if plan.vendor == 'intel':
             size_x, size_y = self.calculated_display_size
-            size_str = 'current ' + str(size_x) + ' x ' + str(size_y)
-            xrandr_output = subprocess.check_output(['xrandr']).decode('utf-8')
-            if size_str not in xrandr_output:
-                if self.get_internal_lid_state():
-                    subprocess.call('xrandr --auto', shell=True)
+            if randrutil.get_screen_size(self.xlib_display) != (size_x, size_y):
+                if plan.lid_open:
+                    if not randrutil.set_screen_size(self.xlib_display, self.xlib_window, size_x, size_y):
+                        self.note_apply_error()
+                    self.display_config.invalidate()
                     # Force Scale to 2x (unless we have only low-dpi + almost-hidpi)
-                    if force == False and dbusutil.get_scale() < 2:
+                    if force == False and self.display_config.get_scale() < 2:
                         workaround_set_hidpi = False
                         if has_lowdpi == False:
                             workaround_set_hidpi = True
-                        for display in self.displays:
-                            if self.displays[display]['connected']:
-                                if self.get_display_dpi(display) > 192:
-                                    workaround_set_hidpi = True
+                        for output in plan.outputs:
+                            if self.get_display_dpi(output.name) > 192:
+                                workaround_set_hidpi = True
                         if workaround_set_hidpi:
-                            try:
-                                dbusutil.set_scale(2)
-                            except:
-                                log.info("Could not set Mutter scale for workaround.")
+                            self.set_scale_nowait(2, "Could not set Mutter scale for workaround.")
                 else:
-                    subprocess.call('xrandr --output eDP-1 --off', shell=True)
+                    self.disable_display('eDP-1')
 
             # Setting the other displays' modes with xlib will also activate previously disabled displays.
-            # We need to turn them off manually.  Using xrandr since I haven't found a better method.
+            # We need to turn them off manually.
             for off_display in off_displays:
-                subprocess.call(['xrandr', '--output', off_display, '--off'])
+                self.disable_display(off_display)
 
         # Displays are all setup - Notify the user!
         self.prev_display_types = (has_mixed_dpi, has_hidpi, has_lowdpi)
         self.notification_send_signal()
+        return self.apply_ok
+
+    def disable_display(self, display_name):
+        display = self.displays.get(display_name)
+        if display is None or not display['crtc']:
+            # Already off.
+            return
+        if not randrutil.disable_crtc(self.xlib_display, display['crtc'], self.resources['config_timestamp']):
+            log.info("Could not disable CRTC for " + str(display_name))
+            self.note_apply_error()
+        self.display_config.invalidate()
 
     def update(self, e):
-        time.sleep(.1)
-        if self.update_display_connections():
-            has_mixed_dpi, has_hidpi, has_lowdpi = self.has_mixed_hi_low_dpi_displays()
-            # NVIDIA: always remember user's selected mode
-            # INTEL: only remember while in same display combination type
-            #        When switching from hidpi-only to mixed-dpi or vice versa, set the appropriate default mode
-            #        remember setting if eg, a user plugs a hidpi display into a hidpi laptop
-            #        or if another display is plugged into an already mixed-dpi config.
-            if self.get_gpu_vendor() == 'nvidia':
-                pass
-            elif not has_lowdpi and self.prev_display_types[2]:
-                self.unforce = True
-                self.settings.set_string('mode', 'hidpi')
-            elif has_mixed_dpi and not self.prev_display_types[0]:
-                self.unforce = False
+        # Called once per burst of events, see scheduler.Coalescer.
+        self.gpu.poll()
+        if self.update_display_connections(incremental=True):
+            self.on_displays_changed()
+        return False
+
+    def on_displays_changed(self):
+        # While disabled, keep tracking the displays but leave the
+        # user's settings alone.
+        if self.config.is_hidpi_disabled():
+            return
+        has_mixed_dpi, has_hidpi, has_lowdpi = self.has_mixed_hi_low_dpi_displays()
+        # NVIDIA: always remember user's selected mode
+        # INTEL: only remember while in same display combination type
+        #        When switching from hidpi-only to mixed-dpi or vice versa, set the appropriate default mode
+        #        remember setting if eg, a user plugs a hidpi display into a hidpi laptop
+        #        or if another display is plugged into an already mixed-dpi config.
+        if self.get_gpu_vendor() == 'nvidia':
+            pass
+        elif not has_lowdpi and self.prev_display_types[2]:
+            self.unforce = True
+            self.settings.set_string('mode', 'hidpi')
+        elif has_mixed_dpi and not self.prev_display_types[0]:
+            self.unforce = False
+            self.settings.set_string('mode', 'lodpi')
+
+        # Work around bug where display event triggers update with bad data, destroying layout
+        if self.get_gpu_vendor() == 'nvidia':
+            if self.mainloop:
+                # Don't block the main loop, continue from a timeout.
+                self.schedule_continuation(100, self.on_nvidia_settle_timeout, has_hidpi)
+                return
+            time.sleep(0.1)
+            self.update_display_connections()
+        self.apply_displays_changed(has_hidpi)
+
+    def apply_displays_changed(self, has_hidpi):
+        if self.get_gpu_vendor() == 'nvidia':
+            if self.workaround_prime_detect_lowdpi_primary():
+                self.scale_mode = 'lowdpi'
                 self.settings.set_string('mode', 'lodpi')
 
-            # Work around bug where display event triggers update with bad data, destroying layout
-            if self.get_gpu_vendor() == 'nvidia':
-                time.sleep(0.1)
-                self.update_display_connections()
+        if self.settings.get_boolean('enable') == False or self.config.is_hidpi_disabled():
+            return
 
-            if self.get_gpu_vendor() == 'nvidia':
-                if self.workaround_prime_detect_lowdpi_primary():
-                    self.scale_mode = 'lowdpi'
-                    self.settings.set_string('mode', 'lodpi')
+        # Don't override user configuration when only lodpi displays are connected.
+        # This appears to be safe for now.
+        if not has_hidpi:
+            return
 
-            if self.settings.get_boolean('enable') == False:
-                return False
+        self.set_scaled_display_modes()
 
-            # Don't override user configuration when only lodpi displays are connected.
-            # This appears to be safe for now.
-            if not has_hidpi:
-                return False
+    def schedule_continuation(self, milliseconds, callback, *args):
+        # Main loop mode: run the rest of an update later instead of
+        # sleeping.  A newer continuation replaces a pending one.
+        if self.pending_source is not None:
+            GLib.source_remove(self.pending_source)
+        self.pending_source = GLib.timeout_add(milliseconds, callback, *args)
 
-            self.set_scaled_display_modes()
+    def on_lid_open_timeout(self):
+        self.pending_source = None
+        self.update_display_connections()
+        self.on_displays_changed()
+        self.dispatch_xlib_events()
+        return False
+
+    def on_nvidia_settle_timeout(self, has_hidpi):
+        self.pending_source = None
+        self.update_display_connections()
+        self.apply_displays_changed(has_hidpi)
+        self.dispatch_xlib_events()
+        return False
+
+    def run_mainloop(self):
+        # X events, D-Bus, GSettings, file monitors, udev, logind and acpid
+        # are all dispatched from this one loop, so nothing races the
+        # configuration code.
+        self.mainloop = True
+        self.update_source = None
+        self.xlib_source = GLib.io_add_watch(self.xlib_display.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR,
+            self.on_xlib_readable)
+        self.rescan_source = GLib.timeout_add_seconds(RESCAN_INTERVAL, self.on_rescan_timeout)
+        # Events read while setting up are already queued.
+        self.dispatch_xlib_events()
+
+        self.loop = GLib.MainLoop()
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGINT, self.notification_terminate, None)
+        self.loop.run()
+
+    def on_xlib_readable(self, fd, condition):
+        if condition & (GLib.IOCondition.HUP | GLib.IOCondition.ERR):
+            log.warning('Lost connection to the X server')
+            self.xlib_source = None
+            self.loop.quit()
+            return False
+        try:
+            self.dispatch_xlib_events()
+        except Exception:
+            log.exception('Error reading X events')
+            self.xlib_source = None
+            self.loop.quit()
+            return False
+        return True
+
+    def dispatch_xlib_events(self):
+        # python-xlib also queues events it reads while waiting for replies,
+        # so drain the queue rather than relying on the fd alone.
+        while self.xlib_display.pending_events():
+            e = self.xlib_display.next_event()
+            if e.type == 34:
+                # Received MappingNotify event.
+                continue
+            if self.record_event(e):
+                self.coalescer.add()
+        self.schedule_update()
+
+    def schedule_update(self):
+        timeout = self.coalescer.get_timeout()
+        if timeout is None or self.update_source is not None:
+            return
+        self.update_source = GLib.timeout_add(int(timeout * 1000), self.on_update_timeout)
+
+    def on_update_timeout(self):
+        self.update_source = None
+        if self.coalescer.due():
+            self.coalescer.take()
+            self.update(None)
+            # Pick up events caused by our own changes.
+            self.dispatch_xlib_events()
+        else:
+            self.schedule_update()
         return False
 
-    def run(self):
-        thread = threading.Thread(target = self.notification_register_dbus, args=(None, self.unforce), daemon=True)
-        thread.start()
+    def teardown(self):
+        # The main loop quit (eg. lost the X connection) and
+        # run_hidpi_autoscaling() is about to start over with a new
+        # instance.  Drop everything run() registered on the process-wide
+        # lid, config and GPU objects and the main loop, so this instance
+        # gets no more callbacks.
+        self.lid.disconnect(self.on_lid_changed)
+        self.config.disconnect(self.on_config_changed)
+        self.gpu.disconnect(self.on_gpu_changed)
+        self.monitors_xml_watch.cancel()
+        for source in (self.xlib_source, self.rescan_source, self.update_source, self.pending_source):
+            if source is not None:
+                GLib.source_remove(source)
+        self.xlib_source = self.rescan_source = self.update_source = self.pending_source = None
+        self.display_config.cancel()
+        if self.notification_settings is not None:
+            self.notification_settings.disconnect(self.notification_mode_handler)
+            Gio.Settings.unbind(self.notification_settings, 'mode')
+            self.notification_settings = None
+        if self.pub is not None:
+            self.pub.unpublish()
+            self.pub = None
+        try:
+            self.xlib_display.close()
+        except Exception:
+            pass
+
+    def on_rescan_timeout(self):
+        # Periodic consistency check, see update_display_connections().
+        if not self.coalescer.pending():
+            self.update(None)
+            self.dispatch_xlib_events()
+        return True
+
+    def run(self, threads=False):
+        self.init_filewatch()
+        self.gpu.connect(self.on_gpu_changed)
+        self.gpu.watch_udev()
+
+        if threads:
+            thread = threading.Thread(target = self.notification_register_dbus, args=(None, self.unforce), daemon=True)
+            thread.start()
+        else:
+            self.notification_publish_dbus()
 
-        thread = threading.Thread(target = self.acpid_listen)
-        thread.start()
+        self.lid.connect(self.on_lid_changed)
+        self.lid.watch_logind()
+        if threads:
+            thread = threading.Thread(target = self.lid.acpid_listen)
+            thread.start()
+        else:
+            self.lid.acpid_watch()
 
         #fix cassidy bug
         self.update_display_connections()
         # First set appropriate initial display configuration
         self.prev_display_types = self.has_mixed_hi_low_dpi_displays()
-        if self.get_gpu_vendor() == 'nvidia':
+        if self.config.is_hidpi_disabled():
+            log.info('HiDPI scaling is disabled, waiting for %r to change', self.config.filename)
+        elif self.get_gpu_vendor() == 'nvidia':
             if self.workaround_prime_detect_lowdpi_primary():
                 self.scale_mode = 'lowdpi'
                 self.settings.set_string('mode', 'lodpi')
@@ -1546,10 +1849,15 @@ class HiDPIAutoscaling:
 
         # calling update fixes overlap bug on first mode set.
         if self.get_gpu_vendor() == 'intel':
+            time.sleep(0.1)
             self.update(None)
 
+        if not threads:
+            self.run_mainloop()
+            self.teardown()
+            return
+
         running = True
-        prev_timestamp = 0
         #mapping_notify_sequence = 0
 
         # Disabling displays is a bit precarious on NVIDIA right now.
@@ -1561,62 +1869,44 @@ class HiDPIAutoscaling:
         # 2) Switch to lowdpi when we detect a lowdpi external monitor via polling
         # 3) Turn on all displays when setting, except those disabled in monitors.xml
         while(running):
-            # Get subscribed xlib RANDR events. Blocks until next event is received.
-            ex = 0
+            # Get subscribed xlib RANDR events.  Bursts of events (eg. a dock
+            # with several monitors) are merged into one update pass.
             try:
-                e = self.xlib_display.next_event()
+                while self.xlib_display.pending_events():
+                    e = self.xlib_display.next_event()
+                    if e.type == 34:
+                        # Received MappingNotify event.
+                        continue
+                    if self.record_event(e):
+                        self.coalescer.add()
             except:
                 time.sleep(0.1)
-                ex = 1
-            if ex == 0:
-                if e.type == self.xlib_display.extension_event.ScreenChangeNotify:
-                    pass
-                elif e.type == 34:
-                    # Received MappingNotify event.
-                    pass
-                    #if e.sequence_number > mapping_notify_sequence:
-                    #   mapping_notify_sequence = e.sequence_number
-                    #   self.update(e)
-                else:
-                    if (e.type + e.sub_code) == self.xlib_display.extension_event.OutputPropertyNotify:
-                            # MUST set e to correct type from binary data.  Otherwise
-                            # we'll have wrong contents, including nonsense timestamp.
-                            e = randr.OutputPropertyNotify(display=self.xlib_display.display, binarydata = e._binary)
-                # Multiple events are fired in quick succession, only act once.
-                try:
-                    new_timestamp = e.timestamp
-                except:
-                    new_timestamp = 0
-                if new_timestamp > prev_timestamp:
-                    prev_timestamp = new_timestamp
-                    self.update(e)
-
-
-
-def _run_hidpi_autoscaling(model):
-    if model in MODEL_MODES:
-        try:
-            # Using subprocess.call() with shell=True because of way xrandr
-            # --newmode needs its arguments.  A better method would be nice.
-            cmd = 'xrandr' + ' --newmode ' + MODEL_MODES[model]
-            subprocess.call(cmd, shell=True)
-        except:
-            log.info('Failed to create new xrandr mode. It may exist already.')
-        try:
-            cmd = ['xrandr', '--addmode'] + ['eDP-1', '1600x900']
-            print(cmd)
-            ##SubProcess.check_output(cmd)
-            #subprocess.call('xrandr --addmode eDP-1 1600x900', shell=True)
-        except:
-            log.warning("Failed to add xrandr mode to display.")
+                continue
+
+            # Wait for more events until the burst is due, or for the next
+            # consistency rescan when idle.
+            timeout = self.coalescer.get_timeout()
+            if timeout is None:
+                timeout = max(0, RESCAN_INTERVAL - (time.monotonic() - self.last_rescan))
+            if timeout > 0:
+                readable, _, _ = select.select([self.xlib_display], [], [], timeout)
+                if readable:
+                    continue
+
+            self.coalescer.take()
+            self.update(None)
+
+
 
+def _run_hidpi_autoscaling(model, threads=False):
+    # Extra modes in MODEL_MODES are created by HiDPIAutoscaling.add_output_mode().
     hidpi = HiDPIAutoscaling(model)
-    hidpi.run()
+    hidpi.run(threads)
 
     return hidpi
 
-def run_hidpi_autoscaling(model):
+def run_hidpi_autoscaling(model, threads=False):
     try:
-        return _run_hidpi_autoscaling(model)
+        return _run_hidpi_autoscaling(model, threads)
     except Exception:
         log.exception('Error calling _run_hidpi_autoscaling(%r):', model)
@@ -0,0 +1,183 @@
+# hidpi-daemon: HiDPI daemon to manage HiDPI and LoDPI monitors on X
+# Copyright (C) 2017-2018 System76, Inc.
+#
+# This file is part of `hidpi-daemon`.
+#
+# `hidpi-daemon` is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# `hidpi-daemon` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with `hidpi-daemon`; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Track the laptop lid state from lid events (acpid, logind) instead of reading procfs on every check.
+"""
+
+import logging
+import os
+import socket
+
+from gi.repository import Gio, GLib
+
+log = logging.getLogger(__name__)
+
+LIDS_PATH = '/proc/acpi/button/lid'
+ACPID_SOCKET = '/var/run/acpid.socket'
+
+
+def read_lid_state(lids_path=LIDS_PATH):
+    try:
+        lid_file_path = os.path.join(lids_path, 'LID0', 'state')
+        if os.path.isfile(lid_file_path):
+            lid_dirs = [d for d in os.listdir(lids_path) if os.path.isdir(os.path.join(lids_path, d))]
+            if len(lid_dirs) < 1:
+                return True # No lids found: System may not be a laptop.
+            else:
+                lid_file_path = os.path.join(lids_path, lid_dirs[0], 'state')
+        with open(lid_file_path, 'r') as lid_file:
+            return 'open' in lid_file.read()
+    except:
+        return True
+
+
+class LidState:
+    # The state is only trusted while at least one event source is feeding
+    # it; without one, is_open() reads procfs like it always did.
+    def __init__(self, lids_path=LIDS_PATH):
+        self.lids_path = lids_path
+        self.open = read_lid_state(lids_path)
+        self.sources = set()
+        self.callbacks = []
+        self.logind = None
+        self.acpid_socket = None
+
+    def is_open(self):
+        if not self.sources:
+            self.open = read_lid_state(self.lids_path)
+        return self.open
+
+    def connect(self, callback):
+        if callback not in self.callbacks:
+            self.callbacks.append(callback)
+
+    def disconnect(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    def set_open(self, is_open):
+        if is_open == self.open:
+            return
+        log.info('lid %s', 'opened' if is_open else 'closed')
+        self.open = is_open
+        for callback in self.callbacks:
+            callback(is_open)
+
+    def acpid_listen(self, filename=ACPID_SOCKET):
+        # Blocks; run in its own thread.
+        if 'acpid' in self.sources:
+            return
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(filename)
+        except OSError:
+            log.info('acpid not available at %r', filename)
+            return
+        self.sources.add('acpid')
+        self.open = read_lid_state(self.lids_path)
+        try:
+            while True:
+                data = s.recv(4096)
+                if not data:
+                    break
+                self.handle_acpid_events(data)
+        finally:
+            self.sources.discard('acpid')
+            s.close()
+
+    def acpid_watch(self, filename=ACPID_SOCKET):
+        # Like acpid_listen(), but dispatched from the GLib main loop.  The
+        # watch outlives a daemon instance, so only the first call connects.
+        if self.acpid_socket is not None:
+            return True
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(filename)
+        except OSError:
+            log.info('acpid not available at %r', filename)
+            s.close()
+            return False
+        s.setblocking(False)
+        self.acpid_socket = s
+        self.sources.add('acpid')
+        self.open = read_lid_state(self.lids_path)
+        GLib.io_add_watch(s.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR,
+            self.on_acpid_readable)
+        return True
+
+    def on_acpid_readable(self, fd, condition):
+        try:
+            data = self.acpid_socket.recv(4096)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b''
+        if not data:
+            log.info('acpid connection closed')
+            self.sources.discard('acpid')
+            self.acpid_socket.close()
+            self.acpid_socket = None
+            return False
+        self.handle_acpid_events(data)
+        return True
+
+    def handle_acpid_events(self, data):
+        for event in data.decode('utf-8').split('\n'):
+            event = event.split(' ')
+            if event[0] == 'button/lid' and len(event) > 2:
+                if event[2] == 'open':
+                    self.set_open(True)
+                elif event[2] == 'close':
+                    self.set_open(False)
+
+    def watch_logind(self):
+        # logind's LidClosed property.  Only count logind as a source once it
+        # has actually announced a change, since not every version emits
+        # PropertiesChanged for it.
+        if self.logind is not None:
+            return
+        try:
+            self.logind = Gio.DBusProxy.new_for_bus_sync(
+                Gio.BusType.SYSTEM, Gio.DBusProxyFlags.NONE, None,
+                'org.freedesktop.login1',
+                '/org/freedesktop/login1',
+                'org.freedesktop.login1.Manager',
+                None,
+            )
+        except Exception:
+            log.info('logind not available')
+            return
+        self.logind.connect('g-properties-changed', self.on_logind_properties_changed)
+
+    def on_logind_properties_changed(self, proxy, changed, invalidated):
+        changed = changed.unpack()
+        if 'LidClosed' in changed:
+            self.sources.add('logind')
+            self.set_open(not changed['LidClosed'])
+
+
+_lid_state = None
+
+def get_lid_state():
+    global _lid_state
+    if _lid_state is None:
+        _lid_state = LidState()
+    return _lid_state
@@ -18,176 +18,157 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 """
-Parse saved monitor configurations in ~.config/monitors.xml.
+Parse saved monitor configurations in ~/.config/monitors.xml.
 """
 
+import logging
+import os
+from os import path
+from xml.etree import ElementTree
 
-class MonitorsXml():
-    def __init__(self):
-        lines = []
-        self.state = []
-        
-        try:
-            fp = open('.config/monitors.xml', 'r')
-        except:
-            self.monitors = []
-            return
-        line = fp.readline()
-        while line:
-            line_type = self.getLineType(line.lstrip())
-            lines.append(line_type)
-            line = fp.readline()
-        
-        for line in lines:
-            self.process_state(line)
-            
-    def getLineType(self, line):
-        if len(line) < 1:
-            return None
-        has_close = False
-        has_end_caret = False
-        has_tag = False
-        complete = False
-        # Lines may have three parts: <opening-tag>contents</closing-tag>
-        
-        # Get opening or closing tag
-        if line[0] == '<':
-            idx = 0
-            for c in line:
-                idx = idx + 1
-                if idx == 2 and c == '/':   # tag is closing tag
-                    has_close = True
-                if c == ' ':                # tag has properties
-                    has_tag = True
-                    tag = line[1:idx-1]
-                if c == '>':                # found end of tag
-                    if not has_tag:
-                        if has_close:
-                            tag = line[2:idx-1]
-                        else:
-                            tag = line[1:idx-1]
-                    has_end_caret = True
-                    remaining_line = line[idx:]
-                    break
-            
-            # Get contents if line isn't finished
-            idx = 0
-            for c in remaining_line:
-                idx = idx + 1
-                if c == '<':
-                    contents = remaining_line[0:idx-1]
-                    remaining_line = remaining_line[idx:]
-            
-            # Get closing tag if line isn't finished
-            idx = 0
-            for c in remaining_line:
-                idx = idx + 1
-                if idx == 2 and c == '/':
-                    has_close = True
-                if c == ' ':
-                    has_tag = True
-                    tag = line[1:idx]
-                if c == '>':
-                    if not has_tag:
-                        if has_close:
-                            tag = remaining_line[2:idx-1]
-                        else:
-                            tag = line[1:idx-1]
-                    has_end_caret = True
-                    if contents:
-                        complete = True
-                    break
-            
-            # Return which type of line we read for processing 
-            if complete:
-                return 'complete', tag, contents
-            if has_end_caret and has_close:
-                return 'close', tag, None
-            elif has_end_caret:
-                return 'open', tag, None
-            else:
-                return 'nope'
-    
-    def process_state(self, line):
-        #line_type = line[0]
-        tag = line[1]
-        contents = line[2]
-        
-        # track state we are in based on recieved tags.
-        # Only process recognized tags.
-        if line[0] == 'open':
-            self.state.append(line[1])
-            if tag == 'monitors':
-                self.monitors = []
-            if tag == 'configuration':
-                self.configuration = {'logical_monitors': [], 'disabled': []}
-            if tag == 'logicalmonitor':
-                self.logical_monitor = {'monitor_spec': {}, 'mode': {}}
-            if tag == 'disabled':
-                self.disabled = {'monitor_spec': {}}
-                self.logical_monitor = {'monitor_spec': {}}
-            if tag == 'monitorspec':
-                self.monitor_spec = {}
-            if tag == 'mode':
-                self.mode = {}
-        elif line[0] == 'close':
-            self.state.pop()
+log = logging.getLogger(__name__)
+
+# Parsed configurations keyed by filename.  Users with a long Mutter history
+# can have hundreds of <configuration> blocks, so only re-parse when the file
+# was actually replaced or modified.  Files in _watched are invalidated by a
+# file monitor (see filewatch.FileWatch), so their cache is trusted without
+# even a stat().
+_cache = {}
+_watched = set()
+
+
+def get_monitors_xml_path():
+    config_home = os.environ.get('XDG_CONFIG_HOME')
+    if not config_home:
+        config_home = path.join(path.expanduser('~'), '.config')
+    return path.join(config_home, 'monitors.xml')
+
+def _get_file_key(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _get_children(elem):
+    children = {}
+    for child in elem:
+        if child.text is not None:
+            children[child.tag] = child.text
+    return children
+
+def parse_monitors_xml(filename):
+    # Stream through the file, building one configuration at a time and
+    # dropping the parsed elements as soon as they have been consumed.
+    monitors = []
+    configuration = None
+    logical_monitor = None
+    stack = []
+    root = None
+    for event, elem in ElementTree.iterparse(filename, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            if root is None:
+                root = elem
+            stack.append(tag)
             if tag == 'configuration':
-                self.monitors.append(self.configuration)
-            if tag == 'logicalmonitor':
-                self.configuration['logical_monitors'].append(self.logical_monitor)
-            if tag == 'disabled':
-                self.configuration['disabled'].append(self.logical_monitor)
-                self.configuration['logical_monitors'].append(self.logical_monitor)
-            if tag == 'monitorspec':
-                self.logical_monitor['monitor_spec'] = self.monitor_spec
-            if tag == 'mode':
-                self.logical_monitor['mode'] = self.mode
-        else:
-            state = self.state.pop()
-            self.state.append(state)
-            if state == 'logicalmonitor':
-                self.logical_monitor[tag] = contents
-            elif state == 'disabled':
-                self.logical_monitor[tag] = contents
-            elif state == 'monitorspec':
-                self.monitor_spec[tag] = contents
-            elif state == 'mode':
-                self.mode[tag] = contents
-    
+                configuration = {'logical_monitors': [], 'disabled': []}
+            elif tag == 'logicalmonitor':
+                logical_monitor = {'monitor_spec': {}, 'monitor_specs': [], 'mode': {}}
+            elif tag == 'disabled':
+                logical_monitor = {'monitor_spec': {}, 'monitor_specs': []}
+            continue
+
+        stack.pop()
+        parent = stack[-1] if stack else None
+        if configuration is None:
+            pass
+        elif tag == 'configuration':
+            monitors.append(configuration)
+            configuration = None
+            root.clear()
+        elif tag == 'logicalmonitor':
+            configuration['logical_monitors'].append(logical_monitor)
+        elif tag == 'disabled':
+            configuration['disabled'].append(logical_monitor)
+            configuration['logical_monitors'].append(logical_monitor)
+        elif logical_monitor is None:
+            pass
+        elif tag == 'monitorspec':
+            # Mirrored logical monitors have one <monitor> per output;
+            # 'monitor_spec' is the last of them.
+            logical_monitor['monitor_spec'] = _get_children(elem)
+            logical_monitor['monitor_specs'].append(logical_monitor['monitor_spec'])
+        elif tag == 'mode' and parent == 'monitor':
+            logical_monitor['mode'] = _get_children(elem)
+        elif parent in ('logicalmonitor', 'disabled') and len(elem) == 0 and elem.text is not None:
+            logical_monitor[tag] = elem.text
+    return monitors
+
+def get_fingerprint(specs):
+    # Canonical, order independent key for a set of monitors given as
+    # (connector, vendor, product, serial) tuples.
+    connections = {}
+    for connector, vendor, product, serial in specs:
+        connections[connector] = (vendor, product, serial)
+    return frozenset(connections.items())
+
+def get_config_fingerprint(config):
+    specs = []
+    for log_mon in config['logical_monitors']:
+        for spec in log_mon['monitor_specs']:
+            specs.append((spec.get('connector'), spec.get('vendor'), spec.get('product'), spec.get('serial')))
+    return get_fingerprint(specs)
+
+def index_configurations(monitors):
+    # Like a linear scan, the first configuration for a monitor set wins.
+    index = {}
+    for config in monitors:
+        index.setdefault(get_config_fingerprint(config), config)
+    return index
+
+def set_watched(filename, watched=True):
+    if watched:
+        _watched.add(filename)
+    else:
+        _watched.discard(filename)
+    invalidate(filename)
+
+def invalidate(filename):
+    _cache.pop(filename, None)
+
+def load_monitors_xml(filename):
+    cached = _cache.get(filename)
+    if cached is not None and filename in _watched:
+        return cached[1], cached[2]
+    key = _get_file_key(filename)
+    if key is None:
+        _cache[filename] = (None, [], {})
+        return [], {}
+    if cached is not None and cached[0] == key:
+        return cached[1], cached[2]
+    try:
+        monitors = parse_monitors_xml(filename)
+    except (OSError, ElementTree.ParseError):
+        log.warning('could not parse %r', filename)
+        monitors = []
+    index = index_configurations(monitors)
+    _cache[filename] = (key, monitors, index)
+    return monitors, index
+
+
+class MonitorsXml():
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = get_monitors_xml_path()
+        self.filename = filename
+        self.monitors, self.index = load_monitors_xml(filename)
+
     def get_config_from_monitors(self, monitor_list):
         # compare monitor list to configurations in monitors.xml
         # if there exists a configuration that matches connector, vendor, product, and serial for every monitor in the list,
         # return that configuration
-        
-        for config in self.monitors:
-            miss = False
-            connections = {}
-            for mon in monitor_list:
-                if mon['connector'] not in connections:
-                    connections[mon['connector']] = {}
-                connections[mon['connector']]['edid_vendor'] = mon['vendor']
-                connections[mon['connector']]['edid_product'] = mon['product']
-                connections[mon['connector']]['edid_serial'] = mon['serial']
-            for log in config['logical_monitors']:
-                if log['monitor_spec']['connector'] not in connections:
-                    connections[log['monitor_spec']['connector']] = {}
-                connections[log['monitor_spec']['connector']]['spec_vendor'] = log['monitor_spec']['vendor']
-                connections[log['monitor_spec']['connector']]['spec_product'] = log['monitor_spec']['product']
-                connections[log['monitor_spec']['connector']]['spec_serial'] = log['monitor_spec']['serial']
-            for connection in connections:
-                for key in ['edid_vendor', 'edid_product', 'edid_serial', 'spec_vendor', 'spec_product', 'spec_serial']:
-                    if key not in connections[connection]:
-                        miss = True
-                if miss == False:
-                    if connections[connection]['spec_vendor'] != connections[connection]['edid_vendor']:
-                        miss = True
-                    if connections[connection]['spec_product'] != connections[connection]['edid_product']:
-                        miss = True
-                    if connections[connection]['spec_serial'] != connections[connection]['edid_serial']:
-                        miss = True
-                    
-            if miss == False:
-                return config
-        return None
-        
+        fingerprint = get_fingerprint(
+            (mon['connector'], mon['vendor'], mon['product'], mon['serial']) for mon in monitor_list
+        )
+        return self.index.get(fingerprint)
@@ -0,0 +1,293 @@
+# hidpi-daemon: HiDPI daemon to manage HiDPI and LoDPI monitors on X
+# Copyright (C) 2017-2018 System76, Inc.
+#
+# This file is part of `hidpi-daemon`.
+#
+# `hidpi-daemon` is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# `hidpi-daemon` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with `hidpi-daemon`; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+NVIDIA metamode handling for the hidpi daemon.  Metamodes are read and set
+through the NV-CONTROL X extension on the daemon's own X connection, falling
+back to spawning nvidia-settings.
+"""
+
+import json
+import logging
+import os
+import re
+import subprocess
+
+from Xlib.error import XError
+
+from hidpidaemon import xlib
+
+log = logging.getLogger(__name__)
+
+# For testing without an NVIDIA driver: a JSON file with a recorded
+# 'CurrentMetaMode' string and a 'dpys' mapping ({"DPY-0": "DP-0", ...}).
+RECORDING_ENV = 'HIDPI_DAEMON_NV_CONTROL_RECORDING'
+
+DEPRETTIFY_RE = re.compile(r'(\n )|(\n\n)')
+DPYS_RE = re.compile(r'\[([0-9])\] (?:.*?)\[dpy\:([.0-9])\] \((.*?)\)')
+
+# Metamode grammar:
+#   [id=50, switchable=no, source=nv-control :: ]entry[, entry...]
+#   entry:      DISPLAY: MODE [@PANNING] [OFFSET] [{KEY=VALUE[, KEY=VALUE...]}]
+# Commas separate entries, except inside the braces.
+PREFIX_SEPARATOR = ' :: '
+ENTRIES_RE = re.compile(r'\s*([^,{}]+(?:\{[^}]*\})?)\s*(?:,|$)')
+ENTRY_RE = re.compile(r"""
+    ^(?P<display>[^:\s]+)\s*:\s*
+    (?P<mode>[^\s{@]+)
+    (?:\s+@(?P<panning>\d+x\d+))?
+    (?:\s+(?P<offset>[+-]\d+[+-]\d+))?
+    \s*(?:\{(?P<attributes>[^}]*)\})?\s*$
+""", re.VERBOSE)
+# Values can contain commas inside parentheses, eg. Transform=(1.0,0.0,...).
+ATTRIBUTE_RE = re.compile(r'\s*([^=,\s]+)\s*=\s*((?:[^,()]|\([^)]*\))*?)\s*(?:,|$)')
+
+# Attributes the daemon sets itself; everything else is kept as-is.
+VIEWPORT_IN = 'ViewPortIn'
+VIEWPORT_OUT = 'ViewPortOut'
+FORCE_COMPOSITION_PIPELINE = 'ForceCompositionPipeline'
+
+
+class MetaModeEntry:
+    __slots__ = ('display', 'mode', 'panning', 'offset', 'attributes')
+
+    def __init__(self, display, mode='nvidia-auto-select', panning=None, offset=None, attributes=None):
+        self.display = display      # 'DPY-1', or a connector name like 'DP-0'
+        self.mode = mode
+        self.panning = panning      # 'WxH'
+        self.offset = offset        # '+X+Y'
+        self.attributes = attributes if attributes is not None else {} # ordered
+
+    @classmethod
+    def parse(cls, text):
+        match = ENTRY_RE.match(text.strip())
+        if match is None:
+            return None
+        attributes = {}
+        if match.group('attributes'):
+            for key, value in ATTRIBUTE_RE.findall(match.group('attributes')):
+                attributes[key] = value
+        return cls(match.group('display'), match.group('mode'),
+                   match.group('panning'), match.group('offset'), attributes)
+
+    def serialize(self):
+        parts = [self.display + ': ' + self.mode]
+        if self.panning:
+            parts.append('@' + self.panning)
+        if self.offset:
+            parts.append(self.offset)
+        if self.attributes:
+            parts.append('{' + ', '.join(k + '=' + v for (k, v) in self.attributes.items()) + '}')
+        return ' '.join(parts)
+
+    def __repr__(self):
+        return 'MetaModeEntry({!r})'.format(self.serialize())
+
+    def __eq__(self, other):
+        # Attribute order doesn't matter to the driver.
+        if not isinstance(other, MetaModeEntry):
+            return NotImplemented
+        return (self.display, self.mode, self.panning, self.offset, self.attributes) \
+            == (other.display, other.mode, other.panning, other.offset, other.attributes)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+
+def parse_metamode(text):
+    # Returns the list of MetaModeEntry of a CurrentMetaMode string, as
+    # reported by NV-CONTROL or 'nvidia-settings -q'.
+    text = DEPRETTIFY_RE.sub(r'', text)
+    if PREFIX_SEPARATOR in text:
+        text = text.rsplit(PREFIX_SEPARATOR, 1)[1]
+    entries = []
+    for chunk in ENTRIES_RE.findall(text):
+        entry = MetaModeEntry.parse(chunk)
+        if entry is not None:
+            entries.append(entry)
+    return entries
+
+def serialize_metamode(entries):
+    return ', '.join(entry.serialize() for entry in entries)
+
+
+def query_current_metamode():
+    output = subprocess.check_output(['nvidia-settings', '-q', 'CurrentMetaMode']).decode("utf-8")
+    return DEPRETTIFY_RE.sub(r'', output)
+
+def query_dpys():
+    return subprocess.check_output(['nvidia-settings', '-q', 'dpys'])
+
+def assign_metamode(metamode):
+    return subprocess.call('nvidia-settings --assign CurrentMetaMode="' + metamode + '"', shell=True)
+
+
+class NvidiaSettings:
+    # The original way: spawn nvidia-settings for everything.
+    name = 'nvidia-settings'
+
+    def get_current_metamode(self):
+        return query_current_metamode()
+
+    def get_dpy_mapping(self, dpys):
+        dpy_mapping = {}
+        for entry in DPYS_RE.findall(str(query_dpys())):
+            idx, dpy_num, connector_name = entry
+            dpy_mapping["DPY-" + dpy_num] = connector_name
+        return dpy_mapping
+
+    def set_current_metamode(self, metamode):
+        return assign_metamode(metamode) == 0
+
+
+class NvControl:
+    # NV-CONTROL requests over an existing python-xlib connection: no new
+    # process or X connection, and no text output to parse.
+    name = 'NV-CONTROL'
+
+    def __init__(self, d, screen=0):
+        self.d = d
+        self.screen = screen
+        self.opcode = d.query_extension(xlib.nv_extname).major_opcode
+
+    @staticmethod
+    def is_available(d):
+        try:
+            return d.query_extension(xlib.nv_extname) is not None
+        except XError:
+            return False
+
+    def query_string(self, attribute, target_id, target_type):
+        reply = xlib._nvctrl_query_string_attribute(self.d, self.opcode, target_id, target_type, attribute)
+        if not reply.flags:
+            return None
+        string = reply.string
+        if isinstance(string, bytes):
+            string = string.decode('utf-8', 'replace')
+        return string.rstrip('\0')
+
+    def get_current_metamode(self):
+        metamode = self.query_string(xlib.NV_CTRL_STRING_CURRENT_METAMODE_VERSION_2,
+                                     self.screen, xlib.NV_CTRL_TARGET_TYPE_X_SCREEN)
+        return metamode or ''
+
+    def get_dpy_mapping(self, dpys):
+        dpy_mapping = {}
+        for dpy in dpys:
+            name = self.query_string(xlib.NV_CTRL_STRING_DISPLAY_NAME_RANDR,
+                                     int(dpy.split('-')[1]), xlib.NV_CTRL_TARGET_TYPE_DISPLAY)
+            if name:
+                dpy_mapping[dpy] = name
+        return dpy_mapping
+
+    def set_current_metamode(self, metamode):
+        reply = xlib._nvctrl_set_string_attribute(self.d, self.opcode, self.screen,
+                                                   xlib.NV_CTRL_STRING_CURRENT_METAMODE_VERSION_2, metamode)
+        if not reply.flags:
+            log.warning('NV-CONTROL rejected metamode %r', metamode)
+            return False
+        return True
+
+
+class RecordedNvControl:
+    # Stand-in replaying recorded replies, and recording what would be set.
+    name = 'recording'
+
+    def __init__(self, filename):
+        with open(filename, 'r') as fp:
+            recording = json.load(fp)
+        self.metamode = recording.get('CurrentMetaMode', '')
+        self.dpys = recording.get('dpys', {})
+        self.assigned = []
+
+    def get_current_metamode(self):
+        return self.metamode
+
+    def get_dpy_mapping(self, dpys):
+        return dict((dpy, self.dpys[dpy]) for dpy in dpys if dpy in self.dpys)
+
+    def set_current_metamode(self, metamode):
+        log.info('CurrentMetaMode=%r (recording, not applied)', metamode)
+        self.assigned.append(metamode)
+        self.metamode = metamode
+        return True
+
+
+def get_backend(d=None):
+    filename = os.environ.get(RECORDING_ENV)
+    if filename:
+        return RecordedNvControl(filename)
+    if d is not None and NvControl.is_available(d):
+        return NvControl(d)
+    return NvidiaSettings()
+
+
+class MetaModeSession:
+    # Each nvidia-settings query takes hundreds of milliseconds and opens its
+    # own X connection.  Query CurrentMetaMode and the DPY-to-connector
+    # mapping once per apply pass (on first use), and build the per-display
+    # metamode strings from that.  Start a new session whenever the metamode
+    # has been changed.
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else NvidiaSettings()
+        self.entries = None     # {connector: MetaModeEntry}
+
+    def load(self):
+        if self.entries is not None:
+            return
+        entries = parse_metamode(self.backend.get_current_metamode())
+        dpys = sorted(set(e.display for e in entries if e.display.startswith('DPY-')))
+        dpy_mapping = self.backend.get_dpy_mapping(dpys)
+        self.entries = {}
+        for entry in entries:
+            self.entries[dpy_mapping.get(entry.display, entry.display)] = entry
+
+    def get_entry(self, display_name, panning, offset, viewportin, viewportout):
+        # A new metamode entry for a display: the current entry's attributes
+        # with the viewports replaced and the composition pipeline forced on.
+        # A display that is currently inactive gets just those.
+        self.load()
+        attributes = {
+            VIEWPORT_IN: viewportin,
+            VIEWPORT_OUT: viewportout,
+        }
+        current = self.entries.get(display_name)
+        if current is not None:
+            for key, value in current.attributes.items():
+                if key not in (VIEWPORT_IN, VIEWPORT_OUT, FORCE_COMPOSITION_PIPELINE):
+                    attributes[key] = value
+        attributes[FORCE_COMPOSITION_PIPELINE] = 'On'
+        return MetaModeEntry(display_name, 'nvidia-auto-select', panning, offset, attributes)
+
+    def is_current(self, entries):
+        # True if assigning these entries (from get_entry()) wouldn't change
+        # the current metamode.
+        self.load()
+        if set(e.display for e in entries) != set(self.entries):
+            return False
+        for entry in entries:
+            current = self.entries[entry.display]
+            if entry != MetaModeEntry(entry.display, current.mode, current.panning, current.offset, current.attributes):
+                return False
+        return True
@@ -0,0 +1,474 @@
+# hidpi-daemon: HiDPI daemon to manage HiDPI and LoDPI monitors on X
+# Copyright (C) 2017-2018 System76, Inc.
+#
+# This file is part of `hidpi-daemon`.
+#
+# `hidpi-daemon` is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# `hidpi-daemon` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with `hidpi-daemon`; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+RandR utility functions for the hidpi daemon.  Keeps round trips to the X server (and output re-probing) off the hotplug path.
+"""
+
+import logging
+
+from Xlib import X
+from Xlib import error as xerror
+from Xlib.error import XError
+from Xlib.ext import randr
+from Xlib.protocol import request as xrequest
+
+from hidpidaemon import xlib
+
+log = logging.getLogger(__name__)
+
+# Physical screen size reported for a new framebuffer size, like xrandr does.
+SCREEN_DPI = 96
+
+# Output property names the daemon matches on, and the values of the
+# ConnectorType property from the RandR spec.
+PROPERTY_ATOMS = (
+    'EDID',
+    randr.PROPERTY_CONNECTOR_TYPE,
+    'PRIME Synchronization',
+)
+
+CONNECTOR_TYPE_ATOMS = (
+    'VGA',
+    'DVI',
+    'DVI-I',
+    'DVI-A',
+    'DVI-D',
+    'HDMI',
+    'Panel',
+    'TV',
+    'TV-Composite',
+    'TV-S-Video',
+    'TV-Component',
+    'TV-SCART',
+    'TV-C4',
+    'DisplayPort',
+)
+
+RRNOTIFY_EVENTS = {
+    randr.RRNotify_CrtcChange: randr.CrtcChangeNotify,
+    randr.RRNotify_OutputChange: randr.OutputChangeNotify,
+    randr.RRNotify_OutputProperty: randr.OutputPropertyNotify,
+}
+
+
+class ScreenResources:
+    # RRGetScreenResources makes the X server re-probe every connector (DDC
+    # reads on every dock port), so only do that once per real hotplug.  A
+    # hotplug changes the config_timestamp; anything else (our own CRTC
+    # changes, Mutter setting a mode) doesn't, and the cheap
+    # RRGetScreenResourcesCurrent returns the same information.
+    def __init__(self, window):
+        self.window = window
+        self.resources = None
+        self.probe_needed = True
+
+    @property
+    def config_timestamp(self):
+        if self.resources is None:
+            return None
+        return self.resources['config_timestamp']
+
+    def invalidate(self, config_timestamp=None):
+        # Request a full probe on the next get().  If the config_timestamp of
+        # the event that triggered this is known, only probe when it changed.
+        if config_timestamp is None or config_timestamp != self.config_timestamp:
+            self.probe_needed = True
+
+    def get(self):
+        if self.probe_needed:
+            resources = self.window.xrandr_get_screen_resources()._data
+            self.probe_needed = False
+        else:
+            resources = randr.get_screen_resources_current(self.window)._data
+        self.resources = resources
+        return resources
+
+
+def _deferred(d, request, **keys):
+    # Queue a RandR request without waiting for its reply.
+    return request(
+        display=d.display,
+        opcode=d.display.get_extension_major(xlib.extname),
+        defer=True,
+        **keys
+    )
+
+def _collect(request):
+    # Wait for the reply to a queued request.  Returns None if the X server
+    # answered with an error (eg. an output that vanished mid-hotplug).
+    try:
+        request.reply()
+    except XError:
+        return None
+    return request._data
+
+
+class AtomRegistry:
+    # Atoms are server-wide and never change while the X server runs, so
+    # intern the names we care about once and match properties by ID.
+    # Names that don't exist yet (eg. 'PRIME Synchronization' before a PRIME
+    # output shows up) are retried when the config_timestamp changes.
+    def __init__(self, d, names=PROPERTY_ATOMS + CONNECTOR_TYPE_ATOMS):
+        self.atoms = {}
+        self.names = {}
+        self.missing = set(names)
+        self.config_timestamp = None
+        self.intern(d)
+
+    def intern(self, d):
+        requests = {}
+        for name in self.missing:
+            requests[name] = xrequest.InternAtom(display=d.display, name=name, only_if_exists=True, defer=True)
+        for name in requests:
+            reply = _collect(requests[name])
+            if reply is not None and reply['atom'] != X.NONE:
+                self.atoms[name] = reply['atom']
+                self.names[reply['atom']] = name
+                self.missing.discard(name)
+
+    def refresh(self, d, config_timestamp):
+        if config_timestamp != self.config_timestamp:
+            self.config_timestamp = config_timestamp
+            if self.missing:
+                self.intern(d)
+
+    def get(self, name):
+        return self.atoms.get(name, X.NONE)
+
+    def get_names(self, d, atoms):
+        unknown = [atom for atom in atoms if atom not in self.names]
+        if unknown:
+            self.names.update(get_atom_names(d, unknown))
+        return dict((atom, self.names.get(atom)) for atom in atoms)
+
+
+_atom_registries = {}
+
+def get_atom_registry(d):
+    # One registry per X server, shared by every connection in the process.
+    key = d.get_display_name()
+    if key not in _atom_registries:
+        _atom_registries[key] = AtomRegistry(d)
+    return _atom_registries[key]
+
+def get_atom_names(d, atoms):
+    requests = {}
+    for atom in atoms:
+        requests[atom] = xrequest.GetAtomName(display=d.display, atom=atom, defer=True)
+    names = {}
+    for atom in requests:
+        reply = _collect(requests[atom])
+        if reply is not None:
+            names[atom] = reply['name']
+    return names
+
+def query_outputs(d, window, resources, edid=False, outputs=None):
+    # Query every output (or just the given ones) with pipelined requests.
+    # Returns (outputs, primary), primary being the primary output's ID or
+    # X.NONE, whichever outputs were queried.  All requests of one round
+    # are sent before any reply is read, so the number of round trips depends
+    # on the depth of the query, not on the number of outputs or properties:
+    #   1) output info, property lists and the primary output
+    #   2) ConnectorType (and EDID) values
+    # Property atoms are matched against the interned AtomRegistry, so no
+    # GetAtomName requests are needed once the registry is warm.
+    config_timestamp = resources['config_timestamp']
+    atoms = get_atom_registry(d)
+    atoms.refresh(d, config_timestamp)
+    edid_atom = atoms.get('EDID')
+    connector_type_atom = atoms.get(randr.PROPERTY_CONNECTOR_TYPE)
+    prime_atom = atoms.get('PRIME Synchronization')
+
+    primary_request = _deferred(d, randr.GetOutputPrimary, window=window)
+    if outputs is None:
+        outputs = resources['outputs']
+    pending = []
+    for output in outputs:
+        pending.append((
+            output,
+            _deferred(d, randr.GetOutputInfo, output=output, config_timestamp=config_timestamp),
+            _deferred(d, randr.ListOutputProperties, output=output),
+        ))
+
+    primary = _collect(primary_request)
+    if primary is not None:
+        primary = primary['output']
+    else:
+        primary = X.NONE
+
+    outputs = []
+    for output, info_request, atoms_request in pending:
+        info = _collect(info_request)
+        properties = _collect(atoms_request)
+        if info is None:
+            continue
+        outputs.append({
+            'output': output,
+            'info': info,
+            'atoms': properties['atoms'] if properties is not None else [],
+            'primary': output == primary,
+            'connector_type': '',
+            'prime': False,
+            'edid': None,
+        })
+
+    property_requests = []
+    for o in outputs:
+        for atom in o['atoms']:
+            if atom == connector_type_atom:
+                property_requests.append((o, 'connector_type',
+                    _deferred(d, randr.GetOutputProperty, output=o['output'], property=atom, type=4,
+                              long_offset=0, long_length=100, delete=False, pending=False)))
+            elif atom == prime_atom:
+                o['prime'] = True
+            elif atom == edid_atom and edid:
+                property_requests.append((o, 'edid',
+                    _deferred(d, randr.GetOutputProperty, output=o['output'], property=atom, type=19,
+                              long_offset=0, long_length=128, delete=False, pending=False)))
+
+    connector_types = {}
+    for o, key, request in property_requests:
+        prop = _collect(request)
+        if prop is None or len(prop['value']) < 1:
+            continue
+        if key == 'edid':
+            o['edid'] = bytes(prop['value'])
+        else:
+            connector_types[o['output']] = prop['value'][0]
+
+    value_names = atoms.get_names(d, set(connector_types.values()))
+    for o in outputs:
+        if o['output'] in connector_types:
+            o['connector_type'] = value_names.get(connector_types[o['output']], '')
+
+    return (outputs, primary)
+
+def parse_rrnotify(d, e):
+    # Decode an RRNotify event into its CrtcChange, OutputChange or
+    # OutputProperty subevent.  Returns None for any other event.  Older
+    # python-xlib doesn't dispatch on the subcode, so always re-parse from the
+    # binary data; otherwise fields (including the timestamp) are nonsense.
+    code = d.extension_event.CrtcChangeNotify
+    if isinstance(code, tuple):
+        code = code[0]
+    if e.type != code:
+        return None
+    event_class = RRNOTIFY_EVENTS.get(getattr(e, 'sub_code', None))
+    if event_class is None:
+        return None
+    return event_class(display=d.display, binarydata=e._binary)
+
+def query_crtcs(d, crtcs, config_timestamp):
+    # Fetch several CRTCs with one round trip.  CRTCs the X server reports an
+    # error for are left out.
+    requests = {}
+    for crtc in crtcs:
+        requests[crtc] = _deferred(d, randr.GetCrtcInfo, crtc=crtc, config_timestamp=config_timestamp)
+    crtc_infos = {}
+    for crtc in requests:
+        info = _collect(requests[crtc])
+        if info is not None:
+            crtc_infos[crtc] = info
+    return crtc_infos
+
+def get_screen_size(d):
+    # The current X screen size: the size of the root window.  Unlike
+    # running 'xrandr', this doesn't make the X server probe the outputs.
+    geometry = d.screen().root.get_geometry()
+    return (geometry.width, geometry.height)
+
+def set_screen_size(d, window, width, height, dpi=SCREEN_DPI):
+    # Resize the X screen, clamped to the range the X server supports.  Every
+    # active CRTC must fit in the new size.  Returns False on error.
+    size_range = window.xrandr_get_screen_size_range()
+    width = min(max(width, size_range.min_width), size_range.max_width)
+    height = min(max(height, size_range.min_height), size_range.max_height)
+    catch = xerror.CatchError()
+    randr.SetScreenSize(
+        display=d.display,
+        opcode=d.display.get_extension_major(xlib.extname),
+        window=window,
+        width=width,
+        height=height,
+        width_in_millimeters=int(round(width * 25.4 / dpi)),
+        height_in_millimeters=int(round(height * 25.4 / dpi)),
+        onerror=catch,
+    )
+    d.sync()
+    if catch.get_error() is not None:
+        log.warning('Could not set screen size to %dx%d: %s', width, height, catch.get_error())
+        return False
+    return True
+
+def disable_crtc(d, crtc, config_timestamp):
+    # Switch a CRTC off (mode None, no outputs), like 'xrandr --output X --off'.
+    # Returns False on error or if the X server refused the change.
+    try:
+        reply = randr.set_crtc_config(d, crtc, config_timestamp, 0, 0, X.NONE, randr.Rotate_0, [])
+    except XError:
+        return False
+    return reply.status == randr.SetConfigSuccess
+
+
+def get_crtc_size(width, height, rotation):
+    # The size a mode covers on the screen.
+    if rotation & (randr.Rotate_90 | randr.Rotate_270):
+        return (height, width)
+    return (width, height)
+
+
+class CrtcTransaction:
+    # Apply the CRTC configs of a whole layout at once.  Setting CRTCs one by
+    # one goes through intermediate layouts: displays flicker, and the
+    # screen can have to grow past its maximum size midway.  Instead:
+    #   1) work out the final screen size from the final CRTC configs,
+    #   2) grab the server,
+    #   3) switch off CRTCs that don't fit in the new size, resize the
+    #      screen, then set every changed CRTC,
+    # with all requests pipelined and their replies read at the end.  Every
+    # request carries the config_timestamp the configs were computed
+    # against, so a hotplug in the meantime makes the X server refuse them
+    # rather than apply a stale layout.
+    def __init__(self, d, window, config_timestamp, crtc_infos):
+        self.d = d
+        self.window = window
+        self.config_timestamp = config_timestamp
+        self.crtc_infos = crtc_infos    # {crtc: info} of the current configs
+        self.configs = {}               # {crtc: (x, y, mode, rotation, outputs)}
+        self.sizes = {}                 # {crtc: (width, height)}
+        self.applied = []               # CRTCs commit() sent a new config for
+        self.stale = False              # The X server refused config_timestamp
+
+    def set_crtc(self, crtc, x, y, mode, rotation, outputs):
+        # mode is a mode dict (see snapshot.ModeTable), or None to switch off.
+        if mode is None:
+            self.configs[crtc] = (0, 0, X.NONE, randr.Rotate_0, ())
+            self.sizes[crtc] = (0, 0)
+        else:
+            self.configs[crtc] = (int(x), int(y), mode['id'], rotation, tuple(outputs))
+            self.sizes[crtc] = get_crtc_size(mode['width'], mode['height'], rotation)
+
+    def is_changed(self, crtc):
+        info = self.crtc_infos.get(crtc)
+        if info is None:
+            return True
+        x, y, mode, rotation, outputs = self.configs[crtc]
+        if mode == X.NONE:
+            return info['mode'] != X.NONE
+        return (info['x'], info['y'], info['mode'], info['rotation'], tuple(info['outputs'])) \
+            != (x, y, mode, rotation, outputs)
+
+    def get_screen_size(self):
+        # Bounding box of every enabled CRTC once the transaction is applied.
+        width = 0
+        height = 0
+        for crtc, info in self.crtc_infos.items():
+            if crtc in self.configs:
+                x, y = self.configs[crtc][:2]
+                w, h = self.sizes[crtc]
+            elif info['mode'] != X.NONE:
+                x, y, w, h = info['x'], info['y'], info['width'], info['height']
+            else:
+                continue
+            width = max(width, x + w)
+            height = max(height, y + h)
+        for crtc in self.configs:
+            if crtc not in self.crtc_infos:
+                x, y = self.configs[crtc][:2]
+                w, h = self.sizes[crtc]
+                width = max(width, x + w)
+                height = max(height, y + h)
+        return (width, height)
+
+    def commit(self, screen_size=None):
+        # Returns True if every request succeeded.
+        changed = [crtc for crtc in self.configs if self.is_changed(crtc)]
+        self.applied = changed
+        if not changed:
+            return True
+        if screen_size is None:
+            screen_size = self.get_screen_size()
+        width, height = screen_size
+        size_range = self.window.xrandr_get_screen_size_range()
+        if width > size_range.max_width or height > size_range.max_height:
+            log.warning('Layout needs a %dx%d screen, more than the maximum %dx%d; not applied',
+                        width, height, size_range.max_width, size_range.max_height)
+            return False
+        width = max(width, size_range.min_width)
+        height = max(height, size_range.min_height)
+        current_size = get_screen_size(self.d)
+
+        requests = []
+        catch = xerror.CatchError()
+        self.d.grab_server()
+        try:
+            # Switch off the CRTCs that would end up outside the new screen.
+            disabled = set()
+            for crtc in changed:
+                info = self.crtc_infos.get(crtc)
+                if info is None or info['mode'] == X.NONE:
+                    continue
+                if self.configs[crtc][2] == X.NONE or info['x'] + info['width'] > width \
+                        or info['y'] + info['height'] > height:
+                    requests.append((crtc, self._set_crtc_config(crtc, 0, 0, X.NONE, randr.Rotate_0, ())))
+                    disabled.add(crtc)
+            if (width, height) != current_size:
+                randr.SetScreenSize(
+                    display=self.d.display,
+                    opcode=self.d.display.get_extension_major(xlib.extname),
+                    window=self.window,
+                    width=width,
+                    height=height,
+                    width_in_millimeters=int(round(width * 25.4 / SCREEN_DPI)),
+                    height_in_millimeters=int(round(height * 25.4 / SCREEN_DPI)),
+                    onerror=catch,
+                )
+            for crtc in changed:
+                x, y, mode, rotation, outputs = self.configs[crtc]
+                if mode == X.NONE and crtc in disabled:
+                    continue
+                requests.append((crtc, self._set_crtc_config(crtc, x, y, mode, rotation, outputs)))
+
+            ok = True
+            for crtc, request in requests:
+                reply = _collect(request)
+                if reply is None:
+                    log.warning('SetCrtcConfig failed for CRTC %r', crtc)
+                    ok = False
+                elif reply['status'] != randr.SetConfigSuccess:
+                    # InvalidConfigTime: the outputs changed since the
+                    # configs were computed.
+                    if reply['status'] == randr.SetConfigInvalidConfigTime:
+                        self.stale = True
+                    log.warning('SetCrtcConfig for CRTC %r returned status %r (config_timestamp %r)',
+                                crtc, reply['status'], self.config_timestamp)
+                    ok = False
+        finally:
+            self.d.ungrab_server()
+            self.d.sync()
+        if catch.get_error() is not None:
+            log.warning('Could not set screen size to %dx%d: %s', width, height, catch.get_error())
+            ok = False
+        return ok
+
+    def _set_crtc_config(self, crtc, x, y, mode, rotation, outputs):
+        return _deferred(self.d, randr.SetCrtcConfig, crtc=crtc, timestamp=X.CurrentTime,
+                         config_timestamp=self.config_timestamp, x=x, y=y, mode=mode,
+                         rotation=rotation, outputs=list(outputs))
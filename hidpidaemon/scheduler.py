@@ -0,0 +1,104 @@
+# hidpi-daemon: HiDPI daemon to manage HiDPI and LoDPI monitors on X
+# Copyright (C) 2017-2018 System76, Inc.
+#
+# This file is part of `hidpi-daemon`.
+#
+# `hidpi-daemon` is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# `hidpi-daemon` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with `hidpi-daemon`; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Collapse bursts of RandR events into a single update pass.
+"""
+
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# Seconds without a new event before a burst is considered over, and the
+# longest an event may wait for its update while a burst keeps going.
+# Overridden by 'event-quiet-window' and 'event-max-latency' in the daemon
+# config.
+QUIET_WINDOW = 0.1
+MAX_LATENCY = 1.0
+
+
+class Coalescer:
+    # Docking several monitors produces dozens of screen, output and CRTC
+    # events within a few hundred milliseconds.  Each add() pushes the update
+    # back by the quiet window, but never more than max_latency after the
+    # first event of the burst.
+    def __init__(self, quiet_window=QUIET_WINDOW, max_latency=MAX_LATENCY, clock=time.monotonic):
+        self.clock = clock
+        self.configure(quiet_window, max_latency)
+        self.first = None
+        self.last = None
+        self.count = 0
+        self.passes = 0
+        self.merged = 0 # Events handled by all passes so far
+
+    def configure(self, quiet_window=QUIET_WINDOW, max_latency=MAX_LATENCY):
+        self.quiet_window = max(0, quiet_window)
+        self.max_latency = max(self.quiet_window, max_latency)
+
+    def add(self):
+        now = self.clock()
+        if self.count == 0:
+            self.first = now
+        self.last = now
+        self.count += 1
+
+    def pending(self):
+        return self.count > 0
+
+    def get_deadline(self):
+        if self.count == 0:
+            return None
+        return min(self.last + self.quiet_window, self.first + self.max_latency)
+
+    def get_timeout(self):
+        # Seconds until the pending burst is due, or None if nothing is pending.
+        deadline = self.get_deadline()
+        if deadline is None:
+            return None
+        return max(0, deadline - self.clock())
+
+    def due(self):
+        return self.count > 0 and self.get_timeout() == 0
+
+    def take(self):
+        # Start the update pass for the current burst.  Returns the number of
+        # events it covers.
+        count = self.count
+        if count > 0:
+            self.passes += 1
+            self.merged += count
+            log.info('%d RandR event(s) merged into update pass %d (%.0f ms)',
+                count, self.passes, (self.clock() - self.first) * 1000)
+        self.first = None
+        self.last = None
+        self.count = 0
+        return count
+
+
+def get_coalescer_settings(config):
+    # (quiet_window, max_latency) from the daemon config, in seconds.
+    values = []
+    for key, default in (('event-quiet-window', QUIET_WINDOW), ('event-max-latency', MAX_LATENCY)):
+        try:
+            values.append(float(config.get(key, default)))
+        except (TypeError, ValueError):
+            log.warning('Invalid %r in %r, using %r', key, config.filename, default)
+            values.append(default)
+    return tuple(values)
@@ -0,0 +1,289 @@
+# hidpi-daemon: HiDPI daemon to manage HiDPI and LoDPI monitors on X
+# Copyright (C) 2017-2018 System76, Inc.
+#
+# This file is part of `hidpi-daemon`.
+#
+# `hidpi-daemon` is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# `hidpi-daemon` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with `hidpi-daemon`; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Immutable snapshots of the RandR display state, and the differences between two snapshots.
+"""
+
+from collections import namedtuple
+
+from hidpidaemon import edid
+
+
+SnapshotDiff = namedtuple('SnapshotDiff', [
+    'added',                # outputs that appeared
+    'removed',              # outputs that went away
+    'connection_changed',   # outputs that were connected or disconnected
+    'crtc_lost',            # outputs whose CRTC was switched off (eg. lid closed)
+    'crtc_gained',          # outputs that got a CRTC
+    'hotplug',              # True if any of the above needs a new configuration
+])
+
+
+class ModeTable:
+    # All RandR modes of the screen, shared by every output.  Outputs only
+    # keep tuples of mode IDs into this table.
+    __slots__ = ('key', 'modes', 'by_size')
+
+    def __init__(self, modes, key=None):
+        self.key = key
+        self.modes = dict()     # {mode_id: mode}
+        self.by_size = dict()   # {(width, height): (mode_id, ...)}
+        for mode in modes:
+            self.modes[mode['id']] = mode
+            size = (mode['width'], mode['height'])
+            self.by_size[size] = self.by_size.get(size, ()) + (mode['id'],)
+
+    def __contains__(self, mode_id):
+        return mode_id in self.modes
+
+    def __getitem__(self, mode_id):
+        return self.modes[mode_id]
+
+    def __len__(self):
+        return len(self.modes)
+
+
+_mode_table = None
+
+def get_mode_table(resources):
+    # One table per config_timestamp.  The mode IDs are part of the key too,
+    # since CreateMode doesn't always bump the timestamp.
+    global _mode_table
+    key = (resources['config_timestamp'], tuple(mode['id'] for mode in resources['modes']))
+    if _mode_table is None or _mode_table.key != key:
+        _mode_table = ModeTable([mode._data for mode in resources['modes']], key)
+    return _mode_table
+
+
+class OutputSnapshot:
+    __slots__ = (
+        'name',
+        'output',
+        'connected',
+        'crtc',
+        'mm_width',
+        'mm_height',
+        'modes',            # tuple of mode IDs, preferred first
+        'primary',
+        'connector_type',
+        'prime',
+        'edid',
+        '_positions',
+        '_key',
+        '_hash',
+    )
+
+    def __init__(self, name, output, connected, crtc, mm_width, mm_height, modes,
+                 primary=False, connector_type='', prime=False, edid=None):
+        key = (name, output, connected, crtc, mm_width, mm_height, tuple(modes),
+               primary, connector_type, prime, edid)
+        positions = dict()
+        for position, mode_id in enumerate(key[6]):
+            positions.setdefault(mode_id, position)
+        for slot, value in zip(self.__slots__, key + (positions, key, hash(key))):
+            object.__setattr__(self, slot, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('OutputSnapshot is immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, OutputSnapshot):
+            return NotImplemented
+        return self._hash == other._hash and self._key == other._key
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return 'OutputSnapshot({!r}, connected={!r}, crtc={!r})'.format(self.name, self.connected, self.crtc)
+
+    def replace(self, **changes):
+        values = dict(zip(self.__slots__, self._key))
+        values.update(changes)
+        return OutputSnapshot(**values)
+
+    def is_internal(self):
+        return 'eDP' in self.name or self.connector_type == 'Panel'
+
+    def has_mode(self, mode_id):
+        return mode_id in self._positions
+
+    def find_mode(self, mode_table, width, height):
+        # The first of this output's modes with the given size, or None.
+        candidates = [m for m in mode_table.by_size.get((width, height), ()) if m in self._positions]
+        if not candidates:
+            return None
+        return mode_table[min(candidates, key=self._positions.get)]
+
+
+def make_output_snapshot(output):
+    # From one entry of randrutil.query_outputs().
+    info = output['info']
+    parsed_edid = None
+    if output['edid'] is not None:
+        parsed_edid = edid.parse_edid(output['edid'])
+    return OutputSnapshot(
+        info['name'],
+        output['output'],
+        not bool(info['connection']),
+        info['crtc'],
+        info['mm_width'],
+        info['mm_height'],
+        info['modes'],
+        primary=output['primary'],
+        connector_type=output['connector_type'],
+        prime=output['prime'],
+        edid=parsed_edid,
+    )
+
+
+class DisplaySnapshot:
+    # The mode table is kept alongside, but two snapshots compare equal if
+    # their outputs and CRTCs are the same: a mode ID always refers to the
+    # same timings on a given X server.
+    __slots__ = ('outputs', 'crtcs', 'mode_table', 'config_timestamp', '_by_name', '_hash')
+
+    def __init__(self, outputs, crtcs=(), mode_table=None, config_timestamp=None):
+        outputs = tuple(sorted(outputs, key=lambda o: o.name))
+        crtcs = tuple(sorted(crtcs))
+        values = (
+            outputs,
+            crtcs,
+            mode_table if mode_table is not None else ModeTable(()),
+            config_timestamp,
+            dict((o.name, o) for o in outputs),
+            hash((outputs, crtcs)),
+        )
+        for slot, value in zip(self.__slots__, values):
+            object.__setattr__(self, slot, value)
+
+    @classmethod
+    def from_outputs(cls, resources, outputs):
+        # Build a snapshot from screen resources and randrutil.query_outputs().
+        snapshots = [make_output_snapshot(output) for output in outputs]
+        return cls(snapshots, resources['crtcs'], get_mode_table(resources), resources['config_timestamp'])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DisplaySnapshot is immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, DisplaySnapshot):
+            return NotImplemented
+        return self._hash == other._hash and self.outputs == other.outputs and self.crtcs == other.crtcs
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return self._hash
+
+    def __iter__(self):
+        return iter(self.outputs)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def __getitem__(self, name):
+        return self._by_name[name]
+
+    def update(self, resources, outputs, primary):
+        # A new snapshot with the given re-queried outputs replaced, keeping
+        # the rest.  Outputs no longer in the screen resources are dropped.
+        # The primary output (from GetOutputPrimary, X.NONE for none) can
+        # change without any output event, so it's applied to every output.
+        by_output = dict((o.output, o) for o in self.outputs)
+        for output in outputs:
+            by_output[output['output']] = make_output_snapshot(output)
+        for o in list(by_output.values()):
+            if o.primary != (o.output == primary):
+                by_output[o.output] = o.replace(primary=(o.output == primary))
+        current = set(resources['outputs'])
+        snapshots = [o for o in by_output.values() if o.output in current]
+        return DisplaySnapshot(snapshots, resources['crtcs'], get_mode_table(resources), resources['config_timestamp'])
+
+    def get_outputs_on_crtc(self, crtc):
+        return [o.output for o in self.outputs if o.crtc == crtc]
+
+    def find_mode(self, name, width, height):
+        return self._by_name[name].find_mode(self.mode_table, width, height)
+
+    def diff(self, old):
+        # Compare against an older snapshot (or None, for the first one).
+        old_outputs = old._by_name if old is not None else {}
+        added = []
+        connection_changed = []
+        crtc_lost = []
+        crtc_gained = []
+        for output in self.outputs:
+            prev = old_outputs.get(output.name)
+            if prev is None:
+                added.append(output.name)
+                continue
+            if output == prev:
+                continue
+            if output.connected != prev.connected:
+                connection_changed.append(output.name)
+            if output.crtc != prev.crtc:
+                if output.crtc == 0:
+                    crtc_lost.append(output.name)
+                elif prev.crtc == 0:
+                    crtc_gained.append(output.name)
+        removed = [name for name in old_outputs if name not in self._by_name]
+        hotplug = bool(added or connection_changed or crtc_lost or crtc_gained
+                       or any(old_outputs[name].connected for name in removed))
+        return SnapshotDiff(
+            tuple(added),
+            tuple(removed),
+            tuple(connection_changed),
+            tuple(crtc_lost),
+            tuple(crtc_gained),
+            hotplug,
+        )
+
+    def get_displays(self):
+        # The per-display dicts the rest of the daemon works with.
+        displays = dict()
+        for output in self.outputs:
+            display = dict()
+            display['connected'] = output.connected
+            display['mm_width'] = output.mm_width
+            display['mm_height'] = output.mm_height
+            # Shared with the mode table; never modify these.
+            display['modes'] = [self.mode_table[mode_id] for mode_id in output.modes if mode_id in self.mode_table]
+            display['crtc'] = output.crtc
+            if output.primary:
+                display['primary'] = True
+            # 'Panel' indicates internal display.
+            display['connector_type'] = output.connector_type
+            if output.prime:
+                display['prime'] = True
+            if output.edid is not None:
+                display['edid'] = output.edid
+            displays[output.name] = display
+        return displays
@@ -0,0 +1,224 @@
+# hidpi-daemon: HiDPI daemon to manage HiDPI and LoDPI monitors on X
+# Copyright (C) 2017-2018 System76, Inc.
+#
+# This file is part of `hidpi-daemon`.
+#
+# `hidpi-daemon` is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# `hidpi-daemon` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with `hidpi-daemon`; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Unit tests for the `hidpidaemon.monitorsxml` module.
+"""
+
+import os
+from unittest import TestCase
+
+from hidpidaemon import monitorsxml
+
+from hidpidaemon.tests.helpers import TempDir
+
+
+def monitor(connector, vendor='MON', product='0x0001', serial='0x00000000', width=1920, height=1080):
+    return """      <monitor>
+        <monitorspec>
+          <connector>{}</connector>
+          <vendor>{}</vendor>
+          <product>{}</product>
+          <serial>{}</serial>
+        </monitorspec>
+        <mode>
+          <width>{}</width>
+          <height>{}</height>
+          <rate>60.000</rate>
+        </mode>
+      </monitor>
+""".format(connector, vendor, product, serial, width, height)
+
+def logical_monitor(x, y, scale, *monitors):
+    return """    <logicalmonitor>
+      <x>{}</x>
+      <y>{}</y>
+      <scale>{}</scale>
+{}    </logicalmonitor>
+""".format(x, y, scale, ''.join(monitors))
+
+def disabled(connector, vendor='MON', product='0x0001', serial='0x00000000'):
+    return """    <disabled>
+      <monitorspec>
+        <connector>{}</connector>
+        <vendor>{}</vendor>
+        <product>{}</product>
+        <serial>{}</serial>
+      </monitorspec>
+    </disabled>
+""".format(connector, vendor, product, serial)
+
+def configuration(*blocks):
+    return '  <configuration>\n{}  </configuration>\n'.format(''.join(blocks))
+
+def monitors_xml(*configurations):
+    return '<monitors version="2">\n{}</monitors>\n'.format(''.join(configurations)).encode('utf-8')
+
+
+class MonitorsXmlTestCase(TestCase):
+    def setUp(self):
+        monitorsxml._cache.clear()
+        monitorsxml._watched.clear()
+        self.tmp = TempDir()
+
+    def tearDown(self):
+        monitorsxml._cache.clear()
+        monitorsxml._watched.clear()
+
+
+class TestParse(MonitorsXmlTestCase):
+    def test_parse_monitors_xml(self):
+        filename = self.tmp.write(monitors_xml(configuration(
+            logical_monitor(0, 0, 2, monitor('eDP-1', 'SHP', '0x1449', width=3840, height=2160)),
+            disabled('HDMI-1', 'GSM'),
+        )), 'monitors.xml')
+        monitors = monitorsxml.parse_monitors_xml(filename)
+        self.assertEqual(len(monitors), 1)
+        config = monitors[0]
+        self.assertEqual(len(config['logical_monitors']), 2)
+        log_mon = config['logical_monitors'][0]
+        self.assertEqual(log_mon['x'], '0')
+        self.assertEqual(log_mon['scale'], '2')
+        self.assertEqual(log_mon['monitor_spec'], {
+            'connector': 'eDP-1',
+            'vendor': 'SHP',
+            'product': '0x1449',
+            'serial': '0x00000000',
+        })
+        self.assertEqual(log_mon['mode'], {'width': '3840', 'height': '2160', 'rate': '60.000'})
+        self.assertEqual(log_mon['monitor_specs'], [log_mon['monitor_spec']])
+
+        # <disabled> blocks are listed on their own, and also count towards
+        # the configuration's monitor set.
+        self.assertEqual(len(config['disabled']), 1)
+        self.assertEqual(config['disabled'][0]['monitor_spec']['connector'], 'HDMI-1')
+        self.assertIs(config['logical_monitors'][1], config['disabled'][0])
+
+    def test_parse_mirrored(self):
+        filename = self.tmp.write(monitors_xml(configuration(
+            logical_monitor(0, 0, 1, monitor('eDP-1', 'SHP'), monitor('HDMI-1', 'GSM')),
+        )), 'monitors.xml')
+        config = monitorsxml.parse_monitors_xml(filename)[0]
+        self.assertEqual(len(config['logical_monitors']), 1)
+        log_mon = config['logical_monitors'][0]
+        self.assertEqual([spec['connector'] for spec in log_mon['monitor_specs']], ['eDP-1', 'HDMI-1'])
+        self.assertEqual(log_mon['monitor_spec']['connector'], 'HDMI-1')
+
+    def test_load_missing_file(self):
+        filename = self.tmp.join('monitors.xml')
+        self.assertEqual(monitorsxml.load_monitors_xml(filename), ([], {}))
+        self.assertEqual(monitorsxml.MonitorsXml(filename).monitors, [])
+
+        # Picked up once it appears.
+        self.tmp.write(monitors_xml(configuration(logical_monitor(0, 0, 1, monitor('eDP-1')))), 'monitors.xml')
+        monitors, index = monitorsxml.load_monitors_xml(filename)
+        self.assertEqual(len(monitors), 1)
+
+    def test_load_bad_file(self):
+        filename = self.tmp.write(b'<monitors version="2"><configuration>', 'monitors.xml')
+        self.assertEqual(monitorsxml.load_monitors_xml(filename), ([], {}))
+
+
+class TestCache(MonitorsXmlTestCase):
+    def test_unchanged(self):
+        filename = self.tmp.write(monitors_xml(configuration(logical_monitor(0, 0, 1, monitor('eDP-1')))), 'monitors.xml')
+        monitors, index = monitorsxml.load_monitors_xml(filename)
+        self.assertIs(monitorsxml.load_monitors_xml(filename)[0], monitors)
+
+    def test_mtime_changed(self):
+        filename = self.tmp.write(monitors_xml(configuration(logical_monitor(0, 0, 1, monitor('eDP-1')))), 'monitors.xml')
+        st = os.stat(filename)
+        monitors, index = monitorsxml.load_monitors_xml(filename)
+        # Same inode and size, only the contents and mtime differ.
+        with open(filename, 'r+b') as fp:
+            fp.write(monitors_xml(configuration(logical_monitor(0, 0, 2, monitor('eDP-1')))))
+        os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        monitors, index = monitorsxml.load_monitors_xml(filename)
+        self.assertEqual(monitors[0]['logical_monitors'][0]['scale'], '2')
+
+    def test_inode_changed(self):
+        filename = self.tmp.write(monitors_xml(configuration(logical_monitor(0, 0, 1, monitor('eDP-1')))), 'monitors.xml')
+        st = os.stat(filename)
+        monitors, index = monitorsxml.load_monitors_xml(filename)
+        # Replaced by a new file of the same size and mtime, like an atomic
+        # save by Mutter.
+        tmp = self.tmp.write(monitors_xml(configuration(logical_monitor(0, 0, 2, monitor('eDP-1')))), 'monitors.xml~')
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, filename)
+        monitors, index = monitorsxml.load_monitors_xml(filename)
+        self.assertEqual(monitors[0]['logical_monitors'][0]['scale'], '2')
+
+    def test_watched(self):
+        filename = self.tmp.write(monitors_xml(configuration(logical_monitor(0, 0, 1, monitor('eDP-1')))), 'monitors.xml')
+        monitorsxml.set_watched(filename)
+        monitors, index = monitorsxml.load_monitors_xml(filename)
+
+        # A watched file is trusted until invalidate(), even once it changed.
+        self.tmp.remove('monitors.xml')
+        self.tmp.write(monitors_xml(configuration(logical_monitor(0, 0, 2, monitor('eDP-1')))), 'monitors.xml')
+        self.assertIs(monitorsxml.load_monitors_xml(filename)[0], monitors)
+
+        monitorsxml.invalidate(filename)
+        monitors, index = monitorsxml.load_monitors_xml(filename)
+        self.assertEqual(monitors[0]['logical_monitors'][0]['scale'], '2')
+
+        # No longer watched: back to checking the file.
+        monitorsxml.set_watched(filename, False)
+        self.assertNotIn(filename, monitorsxml._watched)
+        self.assertIsNot(monitorsxml.load_monitors_xml(filename)[0], monitors)
+
+
+class TestIndex(MonitorsXmlTestCase):
+    def test_fingerprint(self):
+        a = ('eDP-1', 'SHP', '0x1449', '0x00000000')
+        b = ('HDMI-1', 'GSM', '0x5b09', '0x0001')
+        self.assertEqual(monitorsxml.get_fingerprint([a, b]), monitorsxml.get_fingerprint([b, a]))
+        self.assertNotEqual(monitorsxml.get_fingerprint([a, b]), monitorsxml.get_fingerprint([a]))
+
+    def test_first_configuration_wins(self):
+        filename = self.tmp.write(monitors_xml(
+            configuration(logical_monitor(0, 0, 2, monitor('eDP-1', 'SHP'))),
+            configuration(logical_monitor(0, 0, 1, monitor('eDP-1', 'SHP'))),
+            configuration(logical_monitor(0, 0, 1, monitor('eDP-1', 'SHP')), disabled('HDMI-1', 'GSM')),
+        ), 'monitors.xml')
+        monitors, index = monitorsxml.load_monitors_xml(filename)
+        self.assertEqual(len(monitors), 3)
+        self.assertEqual(len(index), 2)
+        xml = monitorsxml.MonitorsXml(filename)
+        config = xml.get_config_from_monitors([
+            {'connector': 'eDP-1', 'vendor': 'SHP', 'product': '0x0001', 'serial': '0x00000000'},
+        ])
+        self.assertIs(config, monitors[0])
+        # Disabled monitors are part of the monitor set.
+        config = xml.get_config_from_monitors([
+            {'connector': 'HDMI-1', 'vendor': 'GSM', 'product': '0x0001', 'serial': '0x00000000'},
+            {'connector': 'eDP-1', 'vendor': 'SHP', 'product': '0x0001', 'serial': '0x00000000'},
+        ])
+        self.assertIs(config, monitors[2])
+
+    def test_mirrored(self):
+        filename = self.tmp.write(monitors_xml(
+            configuration(logical_monitor(0, 0, 1, monitor('eDP-1', 'SHP'), monitor('HDMI-1', 'GSM'))),
+        ), 'monitors.xml')
+        xml = monitorsxml.MonitorsXml(filename)
+        edp = {'connector': 'eDP-1', 'vendor': 'SHP', 'product': '0x0001', 'serial': '0x00000000'}
+        hdmi = {'connector': 'HDMI-1', 'vendor': 'GSM', 'product': '0x0001', 'serial': '0x00000000'}
+        self.assertIs(xml.get_config_from_monitors([edp, hdmi]), xml.monitors[0])
+        self.assertIsNone(xml.get_config_from_monitors([hdmi]))
+        self.assertIsNone(xml.get_config_from_monitors([edp]))
@@ -0,0 +1,104 @@
+# hidpi-daemon: HiDPI daemon to manage HiDPI and LoDPI monitors on X
+# Copyright (C) 2017-2018 System76, Inc.
+#
+# This file is part of `hidpi-daemon`.
+#
+# `hidpi-daemon` is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# `hidpi-daemon` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with `hidpi-daemon`; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Unit tests for the `hidpidaemon.nvidia` module.
+"""
+
+from unittest import TestCase
+
+from hidpidaemon import nvidia
+
+
+TRANSFORM = '(1.000000,0.000000,0.000000,0.000000,1.000000,0.000000,0.000000,0.000000,1.000000)'
+
+METAMODE = ('DP-0: nvidia-auto-select @1920x1080 +0+0 {ViewPortIn=1920x1080, '
+            'ViewPortOut=3840x2160+0+0, Transform=' + TRANSFORM + ', ForceCompositionPipeline=On}, '
+            'DP-2: 1920x1080_60 +1920+0')
+
+
+class DummyBackend:
+    def __init__(self, metamode, dpys=None):
+        self.metamode = metamode
+        self.dpys = dpys if dpys is not None else {}
+
+    def get_current_metamode(self):
+        return self.metamode
+
+    def get_dpy_mapping(self, dpys):
+        return dict((dpy, self.dpys[dpy]) for dpy in dpys if dpy in self.dpys)
+
+
+class TestMetaModeEntry(TestCase):
+    def test_parse(self):
+        entry = nvidia.MetaModeEntry.parse('DPY-1: nvidia-auto-select @1920x1080 +10+0 {ViewPortIn=1920x1080}')
+        self.assertEqual(entry.display, 'DPY-1')
+        self.assertEqual(entry.mode, 'nvidia-auto-select')
+        self.assertEqual(entry.panning, '1920x1080')
+        self.assertEqual(entry.offset, '+10+0')
+        self.assertEqual(entry.attributes, {'ViewPortIn': '1920x1080'})
+
+        entry = nvidia.MetaModeEntry.parse('DP-2: 1920x1080_60 +1920+0')
+        self.assertEqual(entry.mode, '1920x1080_60')
+        self.assertIsNone(entry.panning)
+        self.assertEqual(entry.offset, '+1920+0')
+        self.assertEqual(entry.attributes, {})
+
+        self.assertIsNone(nvidia.MetaModeEntry.parse('NULL'))
+
+    def test_parse_parenthesized_value(self):
+        entry = nvidia.MetaModeEntry.parse('DP-0: nvidia-auto-select {Transform=' + TRANSFORM + ', ForceCompositionPipeline=On}')
+        self.assertEqual(entry.attributes, {
+            'Transform': TRANSFORM,
+            'ForceCompositionPipeline': 'On',
+        })
+
+    def test_eq(self):
+        a = nvidia.MetaModeEntry('DP-0', attributes={'ViewPortIn': '1920x1080', 'ForceCompositionPipeline': 'On'})
+        b = nvidia.MetaModeEntry('DP-0', attributes={'ForceCompositionPipeline': 'On', 'ViewPortIn': '1920x1080'})
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, nvidia.MetaModeEntry('DP-0', offset='+0+0', attributes=b.attributes))
+
+
+class TestFunctions(TestCase):
+    def test_parse_metamode(self):
+        entries = nvidia.parse_metamode('id=50, switchable=no, source=nv-control :: ' + METAMODE)
+        self.assertEqual([e.display for e in entries], ['DP-0', 'DP-2'])
+        self.assertEqual(entries[0].attributes['Transform'], TRANSFORM)
+        self.assertEqual(entries[1].offset, '+1920+0')
+
+    def test_round_trip(self):
+        self.assertEqual(nvidia.serialize_metamode(nvidia.parse_metamode(METAMODE)), METAMODE)
+
+
+class TestMetaModeSession(TestCase):
+    def test_get_entry(self):
+        backend = DummyBackend('DPY-1: nvidia-auto-select @3840x2160 +0+0 {ViewPortIn=3840x2160, '
+                               'Transform=' + TRANSFORM + ', ForceCompositionPipeline=On}',
+                               {'DPY-1': 'DP-0'})
+        session = nvidia.MetaModeSession(backend)
+        entry = session.get_entry('DP-0', '1920x1080', '+0+0', '1920x1080', '3840x2160+0+0')
+        self.assertEqual(entry.serialize(),
+            'DP-0: nvidia-auto-select @1920x1080 +0+0 {ViewPortIn=1920x1080, '
+            'ViewPortOut=3840x2160+0+0, Transform=' + TRANSFORM + ', ForceCompositionPipeline=On}')
+        self.assertFalse(session.is_current([entry]))
+
+        backend.metamode = entry.serialize()
+        session = nvidia.MetaModeSession(backend)
+        self.assertTrue(session.is_current([entry]))
@@ -0,0 +1,121 @@
+# hidpi-daemon: HiDPI daemon to manage HiDPI and LoDPI monitors on X
+# Copyright (C) 2017-2018 System76, Inc.
+#
+# This file is part of `hidpi-daemon`.
+#
+# `hidpi-daemon` is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# `hidpi-daemon` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with `hidpi-daemon`; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Unit tests for the `hidpidaemon.scheduler` module.
+"""
+
+from unittest import TestCase
+
+from hidpidaemon import scheduler
+
+
+class Clock:
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class DummyConfig:
+    filename = 'hidpi.conf'
+
+    def __init__(self, conf):
+        self.conf = conf
+
+    def get(self, key, default=None):
+        return self.conf.get(key, default)
+
+
+class TestCoalescer(TestCase):
+    def test_idle(self):
+        c = scheduler.Coalescer(clock=Clock())
+        self.assertFalse(c.pending())
+        self.assertFalse(c.due())
+        self.assertIsNone(c.get_deadline())
+        self.assertIsNone(c.get_timeout())
+        self.assertEqual(c.take(), 0)
+        self.assertEqual(c.passes, 0)
+
+    def test_quiet_window(self):
+        clock = Clock()
+        c = scheduler.Coalescer(0.1, 1.0, clock=clock)
+        c.add()
+        self.assertTrue(c.pending())
+        self.assertAlmostEqual(c.get_timeout(), 0.1)
+        clock.advance(0.05)
+        c.add()
+        # Pushed back by the new event.
+        self.assertAlmostEqual(c.get_timeout(), 0.1)
+        clock.advance(0.09)
+        self.assertFalse(c.due())
+        clock.advance(0.01)
+        self.assertTrue(c.due())
+        self.assertEqual(c.get_timeout(), 0)
+
+        self.assertEqual(c.take(), 2)
+        self.assertFalse(c.pending())
+        self.assertEqual((c.passes, c.merged), (1, 2))
+
+    def test_max_latency(self):
+        clock = Clock()
+        c = scheduler.Coalescer(0.1, 0.25, clock=clock)
+        c.add()
+        first = clock()
+        for i in range(4):
+            clock.advance(0.06)
+            c.add()
+        # A steady stream of events can't hold the update back for longer
+        # than max_latency after the first one.
+        self.assertAlmostEqual(c.get_deadline(), first + 0.25)
+        self.assertFalse(c.due())
+        clock.advance(0.01)
+        self.assertTrue(c.due())
+        self.assertEqual(c.take(), 5)
+
+        # The next burst starts over.
+        clock.advance(1)
+        c.add()
+        self.assertAlmostEqual(c.get_deadline(), clock() + 0.1)
+
+    def test_configure(self):
+        c = scheduler.Coalescer(clock=Clock())
+        c.configure(-1, 0.5)
+        self.assertEqual((c.quiet_window, c.max_latency), (0, 0.5))
+        # max_latency is never shorter than the quiet window.
+        c.configure(0.5, 0.1)
+        self.assertEqual((c.quiet_window, c.max_latency), (0.5, 0.5))
+
+
+class TestFunctions(TestCase):
+    def test_get_coalescer_settings(self):
+        self.assertEqual(scheduler.get_coalescer_settings(DummyConfig({})),
+                         (scheduler.QUIET_WINDOW, scheduler.MAX_LATENCY))
+        self.assertEqual(scheduler.get_coalescer_settings(DummyConfig({
+            'event-quiet-window': '0.2',
+            'event-max-latency': 2,
+        })), (0.2, 2.0))
+        self.assertEqual(scheduler.get_coalescer_settings(DummyConfig({
+            'event-quiet-window': 'soon',
+            'event-max-latency': None,
+        })), (scheduler.QUIET_WINDOW, scheduler.MAX_LATENCY))
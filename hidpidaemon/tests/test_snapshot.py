@@ -0,0 +1,167 @@
+# hidpi-daemon: HiDPI daemon to manage HiDPI and LoDPI monitors on X
+# Copyright (C) 2017-2018 System76, Inc.
+#
+# This file is part of `hidpi-daemon`.
+#
+# `hidpi-daemon` is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# `hidpi-daemon` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with `hidpi-daemon`; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Unit tests for the `hidpidaemon.snapshot` module.
+"""
+
+from unittest import TestCase
+
+from hidpidaemon import snapshot
+
+
+def make_output(name, output, connected=True, crtc=0, primary=False):
+    # Like an entry of randrutil.query_outputs().
+    return {
+        'output': output,
+        'info': {
+            'name': name,
+            'connection': 0 if connected else 1,
+            'crtc': crtc,
+            'mm_width': 344,
+            'mm_height': 194,
+            'modes': (100, 101),
+        },
+        'edid': None,
+        'primary': primary,
+        'connector_type': 'Panel' if name.startswith('eDP') else 'DisplayPort',
+        'prime': False,
+    }
+
+def make_resources(outputs, crtcs=(60, 61), config_timestamp=1):
+    return {
+        'outputs': outputs,
+        'crtcs': crtcs,
+        'modes': [],
+        'config_timestamp': config_timestamp,
+    }
+
+def make_snapshot(*outputs):
+    resources = make_resources([o['output'] for o in outputs])
+    return snapshot.DisplaySnapshot.from_outputs(resources, outputs)
+
+
+class TestOutputSnapshot(TestCase):
+    def test_immutable(self):
+        o = snapshot.make_output_snapshot(make_output('eDP-1', 70, crtc=60))
+        with self.assertRaises(AttributeError):
+            o.crtc = 0
+        p = o.replace(crtc=0)
+        self.assertEqual(o.crtc, 60)
+        self.assertEqual(p.crtc, 0)
+        self.assertNotEqual(o, p)
+        self.assertEqual(p.replace(crtc=60), o)
+        self.assertEqual(hash(p.replace(crtc=60)), hash(o))
+
+    def test_is_internal(self):
+        self.assertTrue(snapshot.make_output_snapshot(make_output('eDP-1', 70)).is_internal())
+        self.assertFalse(snapshot.make_output_snapshot(make_output('DP-1', 71)).is_internal())
+
+
+class TestDisplaySnapshot(TestCase):
+    def test_eq(self):
+        a = make_snapshot(make_output('eDP-1', 70, crtc=60), make_output('DP-1', 71))
+        b = make_snapshot(make_output('DP-1', 71), make_output('eDP-1', 70, crtc=60))
+        self.assertEqual(a, b)
+        self.assertEqual(hash(a), hash(b))
+        self.assertNotEqual(a, make_snapshot(make_output('eDP-1', 70, crtc=60)))
+
+    def test_diff_first(self):
+        new = make_snapshot(make_output('eDP-1', 70, crtc=60))
+        diff = new.diff(None)
+        self.assertEqual(diff.added, ('eDP-1',))
+        self.assertTrue(diff.hotplug)
+
+    def test_diff_unchanged(self):
+        old = make_snapshot(make_output('eDP-1', 70, crtc=60), make_output('DP-1', 71, connected=False))
+        diff = old.diff(old)
+        self.assertEqual(diff, snapshot.SnapshotDiff((), (), (), (), (), False))
+
+    def test_diff_added_removed(self):
+        old = make_snapshot(make_output('eDP-1', 70, crtc=60), make_output('DP-1', 71))
+        new = make_snapshot(make_output('eDP-1', 70, crtc=60), make_output('DP-2', 72, connected=False))
+        diff = new.diff(old)
+        self.assertEqual(diff.added, ('DP-2',))
+        self.assertEqual(diff.removed, ('DP-1',))
+        self.assertTrue(diff.hotplug)
+
+        # Losing a disconnected output alone isn't a hotplug.
+        old = make_snapshot(make_output('eDP-1', 70, crtc=60), make_output('DP-1', 71, connected=False))
+        new = make_snapshot(make_output('eDP-1', 70, crtc=60))
+        diff = new.diff(old)
+        self.assertEqual(diff.removed, ('DP-1',))
+        self.assertFalse(diff.hotplug)
+
+    def test_diff_connection(self):
+        old = make_snapshot(make_output('eDP-1', 70, crtc=60), make_output('DP-1', 71, connected=False))
+        new = make_snapshot(make_output('eDP-1', 70, crtc=60), make_output('DP-1', 71))
+        diff = new.diff(old)
+        self.assertEqual(diff.connection_changed, ('DP-1',))
+        self.assertEqual(diff.added, ())
+        self.assertTrue(diff.hotplug)
+
+    def test_diff_crtc(self):
+        old = make_snapshot(make_output('eDP-1', 70, crtc=60), make_output('DP-1', 71))
+        new = make_snapshot(make_output('eDP-1', 70), make_output('DP-1', 71, crtc=61))
+        diff = new.diff(old)
+        self.assertEqual(diff.crtc_lost, ('eDP-1',))
+        self.assertEqual(diff.crtc_gained, ('DP-1',))
+        self.assertEqual(diff.connection_changed, ())
+        self.assertTrue(diff.hotplug)
+
+        # Moving to another CRTC, or other changes, aren't a hotplug.
+        new = make_snapshot(make_output('eDP-1', 70, crtc=61), make_output('DP-1', 71, primary=True))
+        diff = new.diff(old)
+        self.assertEqual(diff.crtc_lost, ())
+        self.assertEqual(diff.crtc_gained, ())
+        self.assertFalse(diff.hotplug)
+
+    def test_update(self):
+        old = make_snapshot(make_output('eDP-1', 70, crtc=60), make_output('DP-1', 71), make_output('DP-2', 72))
+        resources = make_resources([70, 71, 73], config_timestamp=2)
+        new = old.update(resources, [make_output('DP-1', 71, crtc=61), make_output('HDMI-1', 73)], 0)
+        self.assertEqual([o.name for o in new], ['DP-1', 'HDMI-1', 'eDP-1'])
+        self.assertIs(new['eDP-1'], old['eDP-1'])
+        self.assertEqual(new['DP-1'].crtc, 61)
+        self.assertEqual(new.config_timestamp, 2)
+        self.assertNotIn('DP-2', new)
+
+    def test_update_primary(self):
+        old = make_snapshot(make_output('eDP-1', 70, crtc=60, primary=True), make_output('DP-1', 71, crtc=61))
+        resources = make_resources([70, 71])
+
+        # The primary moved without an event for either output.
+        new = old.update(resources, [], 71)
+        self.assertFalse(new['eDP-1'].primary)
+        self.assertTrue(new['DP-1'].primary)
+
+        # No primary at all (X.NONE).
+        new = old.update(resources, [], 0)
+        self.assertFalse(any(o.primary for o in new))
+
+        # Unchanged.
+        self.assertEqual(old.update(resources, [], 70), old)
+
+    def test_get_displays(self):
+        displays = make_snapshot(make_output('eDP-1', 70, crtc=60, primary=True), make_output('DP-1', 71)).get_displays()
+        self.assertEqual(sorted(displays), ['DP-1', 'eDP-1'])
+        self.assertTrue(displays['eDP-1']['primary'])
+        self.assertNotIn('primary', displays['DP-1'])
+        self.assertEqual(displays['eDP-1']['connector_type'], 'Panel')
+        self.assertEqual(displays['DP-1']['crtc'], 0)
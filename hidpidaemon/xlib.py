@@ -27,6 +27,39 @@ from Xlib.protocol import rq
 
 extname = 'RANDR'
 
+class _GetScreenResourcesCurrent(rq.ReplyRequest):
+    _request = rq.Struct(
+        rq.Card8('opcode'),
+        rq.Opcode(25),
+        rq.RequestLength(),
+        rq.Window('window'),
+        )
+    _reply = rq.Struct(
+        rq.ReplyCode(),
+        rq.Pad(1),
+        rq.Card16('sequence_number'),
+        rq.ReplyLength(),
+        rq.Card32('timestamp'),
+        rq.Card32('config_timestamp'),
+        rq.LengthOf('crtcs', 2),
+        rq.LengthOf('outputs', 2),
+        rq.LengthOf('modes', 2),
+        rq.LengthOf('names', 2),
+        rq.Pad(8),
+        rq.List('crtcs', rq.Card32Obj),
+        rq.List('outputs', rq.Card32Obj),
+        rq.List('modes', randr.RandR_ModeInfo),
+        rq.String8('names'),
+        )
+
+def _get_screen_resources_current(w):
+    return _GetScreenResourcesCurrent(
+        display=w.display,
+        opcode=w.display.get_extension_major(extname),
+        window=w,
+)
+
+
 class _GetOutputInfo(rq.ReplyRequest):
     _request = rq.Struct(
         rq.Card8('opcode'),
@@ -225,3 +258,80 @@ def _get_output_property(d, output, property, type, long_offset, long_length, de
         delete=delete,
         pending=pending,
 )
+
+
+# NV-CONTROL, the NVIDIA driver's X extension (what nvidia-settings uses).
+# Only the string attribute requests the daemon needs are implemented.
+nv_extname = 'NV-CONTROL'
+
+NV_CTRL_TARGET_TYPE_X_SCREEN = 0
+NV_CTRL_TARGET_TYPE_DISPLAY = 8
+
+NV_CTRL_STRING_CURRENT_METAMODE_VERSION_2 = 45
+NV_CTRL_STRING_DISPLAY_NAME_RANDR = 51
+
+class _NVCtrlQueryStringAttribute(rq.ReplyRequest):
+    _request = rq.Struct(
+        rq.Card8('opcode'),
+        rq.Opcode(4),
+        rq.RequestLength(),
+        rq.Card16('target_id'),
+        rq.Card16('target_type'),
+        rq.Card32('display_mask'),
+        rq.Card32('attribute'),
+        )
+    _reply = rq.Struct(
+        rq.ReplyCode(),
+        rq.Pad(1),
+        rq.Card16('sequence_number'),
+        rq.ReplyLength(),
+        rq.Card32('flags'),
+        rq.LengthOf('string', 4),
+        rq.Pad(16),
+        rq.String8('string'),
+        )
+
+def _nvctrl_query_string_attribute(d, opcode, target_id, target_type, attribute, display_mask=0):
+    return _NVCtrlQueryStringAttribute(
+        display=d.display,
+        opcode=opcode,
+        target_id=target_id,
+        target_type=target_type,
+        display_mask=display_mask,
+        attribute=attribute,
+)
+
+
+class _NVCtrlSetStringAttribute(rq.ReplyRequest):
+    _request = rq.Struct(
+        rq.Card8('opcode'),
+        rq.Opcode(9),
+        rq.RequestLength(),
+        rq.Card16('screen'),
+        rq.Pad(2),
+        rq.Card32('display_mask'),
+        rq.Card32('attribute'),
+        rq.LengthOf('string', 4),
+        rq.String8('string'),
+        )
+    _reply = rq.Struct(
+        rq.ReplyCode(),
+        rq.Pad(1),
+        rq.Card16('sequence_number'),
+        rq.ReplyLength(),
+        rq.Card32('flags'),
+        rq.Pad(20),
+        )
+
+def _nvctrl_set_string_attribute(d, opcode, screen, attribute, string, display_mask=0):
+    # The driver expects the terminating NUL to be part of the string.
+    if isinstance(string, str):
+        string = string.encode('utf-8')
+    return _NVCtrlSetStringAttribute(
+        display=d.display,
+        opcode=opcode,
+        screen=screen,
+        display_mask=display_mask,
+        attribute=attribute,
+        string=string + b'\0',
+)